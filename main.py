@@ -10,7 +10,14 @@ from toolbox import (
 )
 from pytoolbox.config_agent import ConfigAgent
 import toolbox.logger_agent as logger_agent
-from toolbox.data_manager import DataManager
+
+# Startup import budget per mode: the sum of the self times in `python -X importtime main.py`,
+# up to the point the mode starts working (was ~1450 ms for every mode with everything imported up front)
+#   generate - sqlite 650 ms, columns 500 ms, parquet 650 ms
+#   convert  - 900 ms
+#   plot     - points 1500 ms, raster 1300 ms, tiles 1300 ms
+# bokeh, sqlalchemy and pyarrow are only imported by the modes and backends that use them;
+# a module level import of any of them in main or processor blows the generate budget
 
 project_title = 'Composites project'
 
@@ -26,7 +33,26 @@ data_folder = DATA_FOLDER
 stash_folder = STASH_FOLDER
 output_folder = OUTPUT_FOLDER
 data_filepath = os.path.join(data_folder, config.files.data_file_name)
-data_manager = DataManager(data_filepath)
+if config.files.backend == 'parquet':
+    store_path = os.path.join(data_folder, config.files.parquet_folder_name)
+elif config.files.backend == 'columns':
+    store_path = os.path.join(data_folder, config.files.column_folder_name)
+else:
+    store_path = data_filepath
+
+
+def get_data_manager():
+    '''
+    Create the configured data backend, importing only its own module
+    '''
+    if config.files.backend == 'parquet':
+        from toolbox.parquet_store import ParquetDataManager
+        return ParquetDataManager(store_path, config.files.partition_size, logger)
+    if config.files.backend == 'columns':
+        from toolbox.column_store import ColumnStore
+        return ColumnStore(store_path, logger)
+    from toolbox.data_manager import DataManager
+    return DataManager(data_filepath, logger, config.decompose.insert_batch_size, config.decompose.use_wal)
 
 def main():
     start = datetime.utcnow()
@@ -38,8 +64,9 @@ def main():
     config.add_parameter('local', 'output_folder', output_folder)
     config.add_parameter('local', 'html_filepath', html_filepath)
     config.add_parameter('local', 'data_filepath', data_filepath)
+    config.add_parameter('local', 'store_path', store_path)
 
-    pr = Processor(logger=logger, config=config, data_manager=data_manager)
+    pr = Processor(logger=logger, config=config, data_manager=get_data_manager())
     pr.run()
 
 
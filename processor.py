@@ -1,23 +1,42 @@
+from __future__ import annotations
+
 import math
+import multiprocessing
 import os
 import shutil
+import time
+from collections import deque
 from datetime import datetime
-from functools import reduce
 from logging import Logger
+from typing import TYPE_CHECKING
 
 import numpy as np
 import pandas as pd
-import pyprimes as pp
-from bokeh.palettes import (Category10, Cividis, Dark2, Inferno, Magma, Plasma,
-                            Turbo, Viridis)
 from progress.bar import Bar
-from pytoolbox.bokeh_agent import BokehScatterAgent
 from pytoolbox.config_agent import ConfigAgent
 
 import toolbox.mappings as mappings
 from toolbox import STASH_FOLDER
-from toolbox.data_manager import DataManager
-from toolbox.generator import decompose
+from toolbox.factor_codec import decode_prime_factor_lists, decode_prime_factors
+from toolbox.families import FamilyEngine
+from toolbox.generator import Decomposer, decompose_chunks, decompose_window
+from toolbox.manifest import RunManifest
+from toolbox.metrics import compile_columns
+from toolbox.pipeline import BatchWriter, StageClock, log_utilization, timed
+from toolbox.raster import rasterize
+from toolbox.sieve import SegmentedSieve, sieve_primality
+from toolbox.tiles import TileStore
+
+# bokeh, the tile server and sqlalchemy take longer to import than most runs of the other modes take,
+# so they are imported by the methods that use them
+if TYPE_CHECKING:
+    from toolbox.data_manager import DataManager
+
+
+# the set settings that decide which values make up each window of a generate run
+MANIFEST_SETTINGS = ['mode', 'range_min', 'range_max', 'include_primes', 'use_segmented_sieve', 'segment_size', 'list_chunk_size',
+                     'families', 'identity_factor_mode', 'identity_factor_range_min', 'identity_factor_range_max',
+                     'identity_factor_minimum_mode', 'identity_factor_minimum_value', 'identity_factor_count']
 
 
 class Processor():
@@ -48,9 +67,15 @@ class Processor():
         Log settings pertinent to the current run
         '''
         self.logger.info('== SETTINGS ==')
-        if self.cfg.mode.mode == 'generate':
+        self.logger.debug(f'data backend: {self.cfg.files.backend}')
+        if self.cfg.mode.mode == 'convert':
+            self.logger.info('CONVERT')
+            self.logger.info(f'{self.cfg.local.data_filepath} -> {self.cfg.local.store_path}')
+        elif self.cfg.mode.mode == 'generate':
             self.logger.info('GENERATE')
             self.logger.info(f'number generation mode: {self.cfg.set.mode}')
+            self.logger.debug(f'values list chunk size: {self.cfg.set.list_chunk_size}')
+            self.logger.debug(f'decomposers: {self.cfg.decompose.workers or "all cores"}; chunk size: {self.cfg.decompose.chunk_size}; batch size: {self.cfg.decompose.batch_size}; transport: {self.cfg.decompose.transport}; write queue: {self.cfg.decompose.write_queue_size}')
             if self.cfg.set.mode == 'family':
                 self.logger.debug(f'families: {self.cfg.set.families}')
                 self.logger.debug(
@@ -71,10 +96,13 @@ class Processor():
                     f'range [{self.cfg.set.range_min}..{self.cfg.set.range_max}]')
                 self.logger.debug(
                     f'[primes: {"included" if self.cfg.set.include_primes else "excluded"}]')
+                if self.cfg.set.use_segmented_sieve:
+                    self.logger.debug(f'segmented sieve: {self.cfg.set.segment_size} values per window')
         else:
             self.logger.info('PLOT')
             self.logger.info(f'graph size: {self.cfg.plot.width}/{self.cfg.plot.height} x {self.cfg.plot.point_size}pt')
             self.logger.info(f'Y-axis: {self.cfg.plot.mode}')
+            self.logger.info(f'render: {self.cfg.plot.render}')
             self.logger.debug(f'Colorization: {self.cfg.plot.use_color_buckets}')
 
         self.logger.info('==============')
@@ -116,6 +144,8 @@ class Processor():
 
 
     def generate_plot(self, logger: Logger, config: ConfigAgent, data: pd.DataFrame, project_title: str, html_filepath: str):
+        from pytoolbox.bokeh_agent import BokehScatterAgent
+
         plot = BokehScatterAgent()
         plot.set_data(data)
         logger.debug('Plot data set')
@@ -151,13 +181,92 @@ class Processor():
         return plot
     
 
-    def get_data(self, logger: Logger, config: ConfigAgent, data_manager: DataManager) -> pd.DataFrame:
+    def generate_raster_plot(self, logger: Logger, config: ConfigAgent, data: pd.DataFrame, project_title: str, html_filepath: str):
+        '''
+        Bin all points into a pixel grid on the server and embed the grid as a single image
+        '''
+        from bokeh.models import LinearColorMapper
+        from bokeh.plotting import figure, output_file
+
+        config.add_parameter('local', 'plot_points', len(data))
+        graph_params = self.get_graph_params(config, logger, project_title, html_filepath)
+        palette = self.get_palette(palette_name=config.plot.palette)
+
+        bucket_ids = None
+        if config.plot.raster_color == 'bucket':
+            bucket_ids = self.assign_color_buckets(data)
+            if bucket_ids is None:
+                logger.info('No colorization values; coloring by density')
+        step_start = datetime.utcnow()
+        grid, x_extent, y_extent = rasterize(data['value'].to_numpy(), data[graph_params['y_axis']].to_numpy(),
+                                             graph_params['width'], graph_params['height'], bucket_ids)
+        step_end = datetime.utcnow()
+        logger.debug(f'{len(data)} points rasterized in {step_end-step_start}')
+
+        if bucket_ids is None:
+            colors = self.get_palette_colors(palette, max(palette.keys()))
+            color_mapper = LinearColorMapper(palette=colors, low=0, high=max(float(np.nanmax(grid)), 1.0) if len(data) > 0 else 1.0, nan_color='rgba(0, 0, 0, 0)')
+        else:
+            colors = self.get_palette_colors(palette, config.plot.palette_range)
+            color_mapper = LinearColorMapper(palette=colors, low=0, high=len(colors) - 1, nan_color='rgba(0, 0, 0, 0)')
+
+        plot = figure(title=graph_params['title'], width=graph_params['width'], height=graph_params['height'],
+                      x_range=x_extent, y_range=y_extent,
+                      x_axis_label=graph_params['x_axis'], y_axis_label=graph_params['y_axis_label'])
+        plot.image(image=[grid.astype(np.float32)], x=x_extent[0], y=y_extent[0], dw=x_extent[1] - x_extent[0], dh=y_extent[1] - y_extent[0],
+                   color_mapper=color_mapper)
+        output_file(html_filepath, title=graph_params['output_file_title'])
+        logger.info('Plot generated')
+
+        return plot
+
+
+    def serve_tiled_plot(self, logger: Logger, config: ConfigAgent, data_manager: DataManager, project_title: str, html_filepath: str):
+        '''
+        Serve the composites table as zoomable multi-resolution tiles, building the tiles if they are missing or stale
+        '''
+        from toolbox.tile_server import serve_tiles
+
+        metric = mappings.y_axis_values[config.plot.mode]
+        exclude_primes = not config.set.include_primes
+        tile_store = TileStore(os.path.join(config.local.data_folder, config.tiles.folder_name, metric))
+        x_min, x_max, row_count = data_manager.get_column_bounds('value', exclude_primes)
+        settings = {
+            'metric': metric,
+            'exclude_primes': exclude_primes,
+            'levels': config.tiles.levels,
+            'tile_size': config.tiles.tile_size,
+            'y_bins': config.tiles.y_bins,
+            'row_count': row_count,
+            'x_min': x_min,
+            'x_max': x_max,
+        }
+        if not tile_store.is_current(settings):
+            logger.info('Building tiles')
+            step_start = datetime.utcnow()
+            tile_store.build(data_manager, metric, config.tiles.levels, config.tiles.tile_size, config.tiles.y_bins,
+                             exclude_primes, config.tiles.window_size, logger)
+            step_end = datetime.utcnow()
+            logger.debug(f'...done in {step_end-step_start}')
+
+        graph_params = self.get_graph_params(config, logger, project_title, html_filepath)
+        palette = self.get_palette(palette_name=config.plot.palette)
+        colors = self.get_palette_colors(palette, max(palette.keys()))
+        serve_tiles(logger, data_manager, tile_store, graph_params, colors, config.tiles.detail_points, config.tiles.port)
+
+
+    def get_data(self, logger: Logger, config: ConfigAgent, data_manager: DataManager, columns: list = None) -> pd.DataFrame:
         logger.debug('Loading data from file')
-        value_list = self.generate_number_list()
-        data_df = data_manager.load_data(value_list)
-        if len(data_df) < len(value_list):
+        exclude_primes = self.cfg.set.mode == 'range' and not self.cfg.set.include_primes
+        data_batches = []
+        requested_count = 0
+        for value_list, is_prime in self.generate_number_list():
+            requested_count += len(value_list)
+            data_batches.append(data_manager.load_data(value_list, exclude_primes, columns))
+        data_df = pd.concat(data_batches, ignore_index=True) if len(data_batches) > 0 else data_manager.load_data([], exclude_primes, columns)
+        if len(data_df) < requested_count:
             if not self.cfg.set.ignore_missing_plot_values:
-                self.logger.error(f'Requested data is not in the db; {len(value_list) - len(data_df)} records missing')
+                self.logger.error(f'Requested data is not in the db; {requested_count - len(data_df)} records missing')
                 end = datetime.utcnow()
                 self.logger.info(f'End at {end}')
                 self.logger.info(f'Total time: {end-self.cfg.local.start}')
@@ -174,56 +283,69 @@ class Processor():
         return data_df
 
     def generate_number_list(self):
+        '''
+        Iterate the values of the set as (values, is_prime) chunks of at most set.list_chunk_size int64 values
+
+        is_prime is None where the primality of the values is not known (family mode)
+        '''
         self.logger.info('Generating values list')
-        step_start = datetime.utcnow()
         if self.cfg.set.mode == 'family':
             self.logger.debug('..from families')
-            number_list = self.generate_number_families()
+            yield from self.generate_number_families()
         elif self.cfg.set.mode == 'range':
             self.logger.debug('..from range')
-            number_list = self.generate_continuous_number_list()
-        step_end = datetime.utcnow()
-        self.logger.debug(f'...done in {step_end-step_start}')
-        return number_list
+            yield from self.generate_continuous_number_list()
 
     def generate_continuous_number_list(self):
+        '''
+        Sieve the range chunk by chunk; yields the values of each chunk and their primality mask
+        '''
         lowerbound = self.cfg.set.range_min
         upperbound = self.cfg.set.range_max
         if lowerbound < 2:
             lowerbound = 2
-        number_list = []
-        for value in range(lowerbound, upperbound + 1):
-            if pp.isprime(value) and not self.cfg.set.include_primes:
-                continue
-            number_list.append(int(value))
-        return number_list
+        for chunk_start in range(lowerbound, upperbound + 1, self.cfg.set.list_chunk_size):
+            chunk_end = min(chunk_start + self.cfg.set.list_chunk_size - 1, upperbound)
+            number_list = np.arange(chunk_start, chunk_end + 1, dtype=np.int64)
+            is_prime = sieve_primality(chunk_start, chunk_end)
+            if not self.cfg.set.include_primes:
+                number_list = number_list[~is_prime]
+                is_prime = is_prime[~is_prime]
+            yield number_list, is_prime
+
+    def get_identity_factors(self) -> tuple[FamilyEngine, list[int], list[np.ndarray]]:
+        '''
+        Get the family engine, the first identity factor of each family and the identity primes after it
+        The identity primes of all families come from one sieve
+        '''
+        engine = FamilyEngine(self.cfg.set.families)
+        family_count = len(engine.families)
+        if self.cfg.set.identity_factor_mode == 'count':
+            if self.cfg.set.identity_factor_minimum_mode == 'family':
+                largest_family_factors = [family[-1] for family in engine.families]
+                first_identity_factors = [int(primes[0]) for primes in engine.get_primes_above(largest_family_factors, 1)]
+            elif self.cfg.set.identity_factor_minimum_mode == 'origin':
+                first_identity_factors = [2] * family_count
+            else:
+                first_identity_factors = [self.cfg.set.identity_factor_minimum_value] * family_count
+            identity_primes = engine.get_primes_above(first_identity_factors, self.cfg.set.identity_factor_count)
+        else:
+            first_identity_factors = [self.cfg.set.identity_factor_range_min] * family_count
+            identity_primes = [engine.get_primes_in_range(self.cfg.set.identity_factor_range_min, self.cfg.set.identity_factor_range_max)] * family_count
+
+        return engine, first_identity_factors, identity_primes
 
     def generate_number_families(self):
-        processed_numbers = []
-        for family in self.cfg.set.families:
-            # order family
-            family = sorted(family)
-            family_product = np.prod(family)
-            if self.cfg.set.identity_factor_mode == 'count':
-                if self.cfg.set.identity_factor_minimum_mode == 'family':
-                    largest_family_factor = family[-1]
-                    larger_primes = pp.primes_above(largest_family_factor)
-                    first_identity_factor = next(larger_primes)
-                elif self.cfg.set.identity_factor_minimum_mode == 'origin':
-                    first_identity_factor = 2
-                else:
-                    first_identity_factor = self.cfg.set.identity_factor_minimum_value
-                number_of_composites = self.cfg.set.identity_factor_count
-            else:
-                first_identity_factor = self.cfg.set.identity_factor_range_min
-                number_of_composites = pp.prime_count(self.cfg.set.identity_factor_range_max) - pp.prime_count(self.cfg.set.identity_factor_range_min)
+        '''
+        Yield the family composites in chunks
+        '''
+        engine, first_identity_factors, identity_primes = self.get_identity_factors()
+        chunk_size = self.cfg.set.list_chunk_size
+        for family_index in range(len(engine.families)):
             # iterate identity factors
-            processed_numbers.append(int(family_product * first_identity_factor))
-            prime_generator = pp.primes_above(first_identity_factor)
-            for count in range(number_of_composites):
-                processed_numbers.append(int(family_product * next(prime_generator)))
-
-        return processed_numbers
+            identity_factors = np.concatenate(([first_identity_factors[family_index]], identity_primes[family_index])).astype(np.int64)
+            for chunk_start in range(0, len(identity_factors), chunk_size):
+                yield engine.get_family_values(family_index, identity_factors[chunk_start:chunk_start + chunk_size]), None
 
     def stash_log_file(self, log_filename_prefix: str):
         # ensure stash folder exists
@@ -242,43 +364,204 @@ class Processor():
         open(logger_filepath, 'w').close()
 
 
+    def convert(self):
+        '''
+        Copy the sqlite data file into the configured data backend
+        '''
+        if self.cfg.files.backend == 'sqlite':
+            self.logger.error('Set the files backend to parquet or columns to convert the sqlite data file')
+            return
+        from toolbox.data_manager import convert_sqlite_store
+
+        self.logger.info('Converting data')
+        step_start = datetime.utcnow()
+        convert_sqlite_store(self.cfg.local.data_filepath, self.data_manager, logger=self.logger)
+        step_end = datetime.utcnow()
+        self.logger.debug(f'...done in {step_end-step_start}')
+
+
+    def generate_segmented(self):
+        '''
+        Generate range data window by window, saving each window before moving on
+        '''
+        run_start = time.perf_counter()
+        manifest = self.open_manifest()
+        sieve = SegmentedSieve(max(self.cfg.set.range_min, 2), self.cfg.set.range_max, self.cfg.set.segment_size)
+        self.logger.info(f'Walking range in windows of {self.cfg.set.segment_size} values')
+        self.logger.debug(f'{len(sieve.base_primes)} base primes up to {math.isqrt(self.cfg.set.range_max)}')
+        sieve_clock = StageClock('sieve')
+        writer = BatchWriter(self.data_manager, self.cfg.decompose.write_queue_size, self.logger)
+        for window_index, (lower, upper) in enumerate(sieve.windows()):
+            if manifest.is_done(str(window_index)):
+                continue
+            step_start = time.perf_counter()
+            window = sieve.factor_window(lower, upper)
+            if not self.cfg.set.include_primes:
+                window = window.select(~window.is_prime)
+            try:
+                existing_data = self.data_manager.load_value_data(window.values.tolist())
+                if len(existing_data) > 0:
+                    window = window.select(~np.isin(window.values, existing_data['value'].to_numpy()))
+            except Exception as e:
+                self.logger.debug('Could not load existing data records')
+            if len(window) == 0:
+                self.logger.debug(f'[{lower}..{upper}] already in the db')
+                manifest.mark_done(str(window_index), lower, upper)
+                sieve_clock.add(step_start)
+                continue
+            collection_df = decompose_window(window)
+            sieve_clock.add(step_start)
+            self.logger.debug(f'[{lower}..{upper}] {len(window)} values factored in {time.perf_counter() - step_start:.2f}s')
+            writer.put(collection_df, lambda saved_count, window_index=window_index, lower=lower, upper=upper: manifest.mark_done(str(window_index), lower, upper))
+        writer.close()
+        log_utilization(self.logger, time.perf_counter() - run_start, [sieve_clock, writer.write_clock], writer.blocked_clock.busy)
+
+
+    def generate_families(self):
+        '''
+        Generate family data from the known factorization of every value: the family factors plus the identity prime
+
+        Only the first identity factor of a family, which need not be prime, goes through the decomposer
+        '''
+        run_start = time.perf_counter()
+        manifest = self.open_manifest()
+        engine, first_identity_factors, identity_primes = self.get_identity_factors()
+        chunk_size = self.cfg.set.list_chunk_size
+        factor_clock = StageClock('factor')
+        writer = BatchWriter(self.data_manager, self.cfg.decompose.write_queue_size, self.logger)
+        for family_index, family in enumerate(engine.families):
+            self.logger.info(f'Family {family}: {len(identity_primes[family_index]) + 1} values')
+            # families may share values, so the earlier ones have to be in the db before this one is filtered
+            writer.flush()
+            first_values = engine.get_family_values(family_index, np.array([first_identity_factors[family_index]], dtype=np.int64))
+            if not manifest.is_done(f'{family_index}:first'):
+                first_value = int(first_values[0])
+                if self.get_new_value_mask(first_values).all():
+                    writer.put(pd.DataFrame(Decomposer().decompose_chunk(first_values)),
+                               lambda saved_count, window=f'{family_index}:first', first_value=first_value: manifest.mark_done(window, first_value, first_value))
+                else:
+                    manifest.mark_done(f'{family_index}:first', first_value, first_value)
+            for chunk_start in range(0, len(identity_primes[family_index]), chunk_size):
+                window = f'{family_index}:{chunk_start}'
+                if manifest.is_done(window):
+                    continue
+                step_start = time.perf_counter()
+                chunk_primes = identity_primes[family_index][chunk_start:chunk_start + chunk_size]
+                chunk_values = engine.get_family_values(family_index, chunk_primes)
+                is_new = self.get_new_value_mask(chunk_values)
+                if not is_new.any():
+                    self.logger.debug(f'[{chunk_primes[0]}..{chunk_primes[-1]}] already in the db')
+                    manifest.mark_done(window, int(chunk_values[0]), int(chunk_values[-1]))
+                    factor_clock.add(step_start)
+                    continue
+                chunk_primes = chunk_primes[is_new]
+                factors, counts = engine.factor_family_values(family_index, chunk_primes)
+                values = engine.get_family_values(family_index, chunk_primes)
+                collection_df = pd.DataFrame(compile_columns(values, counts == 1, factors, counts))
+                factor_clock.add(step_start)
+                self.logger.debug(f'[{chunk_primes[0]}..{chunk_primes[-1]}] {len(collection_df)} values factored in {time.perf_counter() - step_start:.2f}s')
+                writer.put(collection_df, lambda saved_count, window=window, first_value=int(chunk_values[0]), last_value=int(chunk_values[-1]):
+                           manifest.mark_done(window, first_value, last_value))
+        writer.close()
+        log_utilization(self.logger, time.perf_counter() - run_start, [factor_clock, writer.write_clock], writer.blocked_clock.busy)
+        if writer.saved_count == 0:
+            self.logger.info('Data is already in the db')
+
+
     def generate(self):
-        number_list = self.generate_number_list()
-        # filter existing data
-        terminate = False
+        if self.cfg.set.mode == 'range' and self.cfg.set.use_segmented_sieve:
+            self.generate_segmented()
+            return
+        if self.cfg.set.mode == 'family':
+            self.generate_families()
+            return
+        # values are generated, filtered and decomposed chunk by chunk, while a writer thread saves the finished batches
+        run_start = time.perf_counter()
+        manifest = self.open_manifest()
+        window_queue = deque()
+        feed_clock = StageClock('feed')
+        value_chunks = timed(self.filter_existing_values(self.generate_number_list(), manifest, window_queue), feed_clock)
+        value_range = (self.cfg.set.range_min, self.cfg.set.range_max) if self.cfg.set.mode == 'range' else None
+        worker_stats = {}
+        writer = BatchWriter(self.data_manager, self.cfg.decompose.write_queue_size, self.logger)
+        batches = decompose_chunks(self.logger, value_chunks, value_range, self.cfg.decompose.workers,
+                                   self.cfg.decompose.chunk_size, self.cfg.decompose.batch_size, self.cfg.decompose.transport, worker_stats,
+                                   self.cfg.decompose.spf_table_limit)
+        for collection_df in batches:
+            writer.put(collection_df, lambda saved_count: self.mark_saved_windows(manifest, window_queue, saved_count))
+            # shared memory blocks stay open until the writer is done with their frames
+            del collection_df
+        writer.close()
+        self.mark_saved_windows(manifest, window_queue)
+
+        decompose_clock = StageClock('decompose', self.cfg.decompose.workers or multiprocessing.cpu_count())
+        decompose_clock.busy = sum(busy_time for values_count, chunks_count, busy_time in worker_stats.values())
+        log_utilization(self.logger, time.perf_counter() - run_start, [feed_clock, decompose_clock, writer.write_clock], writer.blocked_clock.busy)
+        if writer.saved_count == 0:
+            self.logger.info('Data is already in the db')
+
+
+    def open_manifest(self) -> RunManifest:
+        '''
+        Open the manifest of finished windows kept next to the data store
+
+        It is dropped if the data store is gone or was generated with other set settings
+        '''
+        settings = {key: getattr(self.cfg.set, key) for key in MANIFEST_SETTINGS}
+        resume = self.cfg.set.resume and os.path.exists(self.cfg.local.store_path)
+        manifest = RunManifest(f'{self.cfg.local.store_path}.manifest.json', settings, resume)
+        if len(manifest) > 0:
+            self.logger.info(f'Resuming run; {len(manifest)} window(s) already done')
+        return manifest
+
+
+    def mark_saved_windows(self, manifest: RunManifest, window_queue: deque, saved_count: int = None):
+        '''
+        Mark the queued windows whose records are all saved as done; without a saved count, all of them
+        '''
+        while len(window_queue) > 0 and (saved_count is None or window_queue[0][3] <= saved_count):
+            window, first_value, last_value, queued_count = window_queue.popleft()
+            manifest.mark_done(window, first_value, last_value)
+
+
+    def get_new_value_mask(self, number_list: np.ndarray) -> np.ndarray:
+        '''
+        Mark the values that are not in the db yet
+        '''
         try:
-            starting_value_count = len(number_list)
             existing_data = self.data_manager.load_value_data(number_list)
-            if len(existing_data) == len(number_list):
-                self.logger.info('Data is already in the db')
-                end = datetime.utcnow()
-                self.logger.info(f'End at {end}')
-                self.logger.info(f'Total time: {end-self.cfg.local.start}')
-                terminate = True
-            else:
-                number_list = [value for value in number_list if value not in existing_data['value'].tolist()]
-                if starting_value_count > len(number_list):
-                    self.logger.debug(f'{starting_value_count - len(number_list)} record(s) found in the db; proceeding with {len(number_list)} values')
-                else:
-                    self.logger.debug('All values are new; proceeding with values')
+            return ~np.isin(number_list, existing_data['value'].to_numpy(dtype=np.int64))
         except Exception as e:
             self.logger.debug('Could not load existing data records')
             self.logger.debug('Proceeding with all values')
-        if terminate:
-            exit()
-        collection_df = decompose(self.logger, number_list)
-        self.logger.info('Saving data')
-        step_start = datetime.utcnow()
-        self.data_manager.save_data(collection_df)
-        step_end = datetime.utcnow()
-        self.logger.debug(f'...done in {step_end-step_start}')
+            return np.ones(len(number_list), dtype=bool)
+
+
+    def filter_existing_values(self, value_chunks, manifest: RunManifest, window_queue: deque):
+        '''
+        Drop the windows the manifest has as done, and the values already in the db from each (values, is_prime) chunk
 
+        Every other window is queued with the number of values handed out up to its end, so it can be
+        marked done once that many records are saved; batches come back in the order the chunks went out
+        '''
+        queued_count = 0
+        for window_index, (number_list, is_prime) in enumerate(value_chunks):
+            window = str(window_index)
+            if manifest.is_done(window) or len(number_list) == 0:
+                continue
+            is_new = self.get_new_value_mask(number_list)
+            new_count = int(np.count_nonzero(is_new))
+            if new_count < len(number_list):
+                self.logger.debug(f'{len(number_list) - new_count} record(s) found in the db; proceeding with {new_count} values')
+            queued_count += new_count
+            window_queue.append((window, int(number_list[0]), int(number_list[-1]), queued_count))
+            if new_count == 0:
+                continue
+            yield number_list[is_new], None if is_prime is None else is_prime[is_new]
 
-    def parse_factors(self, factors_string: str) -> list[int]:
-        factors_str_list = factors_string.split(sep=",")
-        factors_int_list = [int(value) for value in factors_str_list]
 
-        return factors_int_list
+    def parse_factors(self, stored_factors) -> list[int]:
+        return decode_prime_factor_lists([stored_factors])[0]
 
 
     def get_max_sum(self, limit: int, base: int):
@@ -337,6 +620,8 @@ class Processor():
         '''
         Returns a bokeh palette, corresponding to a given str palette name
         '''
+        from bokeh.palettes import Category10, Cividis, Dark2, Inferno, Magma, Plasma, Turbo, Viridis
+
 
         # Magma, Inferno, Plasma, Viridis, Cividis, Turbo
         if palette_name == 'Magma':
@@ -359,6 +644,15 @@ class Processor():
             return Turbo
     
 
+    def get_palette_colors(self, palette: dict, color_count: int) -> list:
+        '''
+        Get the smallest variant of a palette with at least color_count colors (or the largest one)
+        '''
+        sizes = sorted(palette.keys())
+        fitting_sizes = [size for size in sizes if size >= color_count]
+        return palette[fitting_sizes[0] if fitting_sizes else sizes[-1]]
+
+
     def get_binary_buckets_map(self, binary_buckets):
         bucket_map = {}
         step_start = datetime.utcnow()
@@ -374,8 +668,8 @@ class Processor():
         return bucket_map
 
 
-    def get_sorted_property_uniques_list(self, data: pd.DataFrame, parameter: str, use_rounding: bool) -> list:
-        """Compile a list of all unique values, determined by a given number parameter
+    def get_sorted_property_uniques(self, data: pd.DataFrame, parameter: str, use_rounding: bool) -> np.ndarray:
+        """Compile an ascending array of all unique values, determined by a given number parameter
 
         Parameters
         ----------
@@ -388,108 +682,170 @@ class Processor():
 
         Returns
         -------
-        list:
-            a list of all unique values of the given number parameter
+        np.ndarray:
+            all unique values of the given number parameter, in ascending order
 
         """
         step_start = datetime.utcnow()
         if use_rounding == 'down':
-            data[parameter] = data[parameter].apply(lambda value: math.floor(value))
+            data[parameter] = np.floor(data[parameter].to_numpy()).astype(np.int64)
         elif use_rounding == 'up':
-            data[parameter] = data[parameter].apply(lambda value: math.ceil(value))
-        
-        uniques_list = data[parameter].tolist()
-        uniques_list = reduce(lambda lst, x: lst.append(x) or lst if x not in lst else lst, uniques_list, [])
+            data[parameter] = np.ceil(data[parameter].to_numpy()).astype(np.int64)
+
+        sorted_uniques = np.unique(data[parameter].to_numpy())
         step_end = datetime.utcnow()
         self.logger.debug(f'...done in {step_end-step_start}')
-        sorted_uniques_list = sorted(uniques_list)
-        sorted_uniques_list.reverse()
 
-        return sorted_uniques_list
+        return sorted_uniques
 
 
-    def get_buckets(self, sorted_buckets_list: list, palette) -> dict:
+    def get_buckets(self, sorted_uniques: np.ndarray, palette) -> np.ndarray:
         '''
         Split numbers into buckets by a given property
 
         The first bucket contains numbers with one property value
         The next bucket contains X times more property values than the previous one
         X is determined so that the palette can cover all property values
+
+        Returns the largest property value of each bucket, in ascending order
         '''
 
         step_start = datetime.utcnow()
         global palette_color_range
 
-        number_of_unassigned_buckets = len(sorted_buckets_list)
+        number_of_unassigned_buckets = len(sorted_uniques)
         palette_color_range = self.get_number_of_colors_in_palette(palette=palette)
         bucket_base = self.get_bucket_base(palette_color_range, number_of_unassigned_buckets)
         self.logger.info(f'Colorization values to be distributed: {number_of_unassigned_buckets}')
         self.logger.info(f'Base chosen: {bucket_base}')
 
-        binary_bucket_index_map = {}
+        # bucket i holds the next bucket_base ** i property values, smallest first
+        bucket_ends = []
+        assigned_count = 0
         binary_bucket_index = 0
-        bucket_size = pow(bucket_base, binary_bucket_index)
-        for counter in range(len(sorted_buckets_list)):
-            next_value = sorted_buckets_list.pop()
-            binary_bucket_index_map[next_value] = binary_bucket_index
-            
-            bucket_size -= 1
-            if bucket_size == 0:
-                binary_bucket_index += 1
-                bucket_size = pow(bucket_base, binary_bucket_index)
-        
+        while assigned_count < number_of_unassigned_buckets:
+            assigned_count = min(assigned_count + pow(bucket_base, binary_bucket_index), number_of_unassigned_buckets)
+            bucket_ends.append(assigned_count)
+            binary_bucket_index += 1
+        bucket_boundaries = sorted_uniques[np.asarray(bucket_ends, dtype=np.int64) - 1] if bucket_ends else sorted_uniques
+
         step_end = datetime.utcnow()
         self.logger.debug(f'...done in {step_end-step_start}')
-        return binary_bucket_index_map
+        return bucket_boundaries
 
 
-    def collection_to_df(self, data: pd.DataFrame, palette_range: int, colorization_field: str) -> pd.DataFrame:
-        # add coloration index column
-        rawdict = data.to_dict(orient='records')
-        data_dict = {}
-        data_dict['value'] = []
-        data_dict['is_prime'] = []
-        data_dict['prime_factors'] = []
-        data_dict['small_factors'] = []
-        data_dict['largest_factor'] = []
-        data_dict['division_family'] = []
-        data_dict['ideal_factor'] = []
-        data_dict['mean_deviation'] = []
-        data_dict['antislope'] = []
-        data_dict['color_bucket'] = []
-        
-        colorization_field = mappings.colorization_field[self.cfg.plot.colorization_value]
-        # organize numbers by colorization property
-        sorted_property_uniques_list = self.get_sorted_property_uniques_list(data, parameter=colorization_field, use_rounding=self.cfg.plot.property_rounding)
-        palette = self.get_palette(palette_name=self.cfg.plot.palette)
-        binary_buckets = self.get_buckets(sorted_property_uniques_list, palette)
+    def get_bucket_ids(self, values: pd.Series, bucket_boundaries: np.ndarray) -> np.ndarray:
+        '''
+        Map property values onto bucket ids, given the largest value of each bucket
+        '''
+        return np.searchsorted(bucket_boundaries, values.to_numpy(), side='left')
 
 
+    def assign_color_buckets(self, data: pd.DataFrame) -> np.ndarray:
+        '''
+        Get the color bucket id of every row; None if the colorization property is 0 throughout
+        '''
+        colorization_field = mappings.colorization_field[self.cfg.plot.colorization_value]
+        # organize numbers by colorization property; rounding only applies to the bucket assignment
+        color_data = data[[colorization_field]].copy()
+        sorted_property_uniques = self.get_sorted_property_uniques(color_data, parameter=colorization_field, use_rounding=self.cfg.plot.property_rounding)
+        palette = self.get_palette(palette_name=self.cfg.plot.palette)
+        bucket_boundaries = self.get_buckets(sorted_property_uniques, palette)
 
-        max_value = (data[colorization_field].max())
+        max_value = (color_data[colorization_field].max())
         # check for values
         if max_value == 0:
             return None
 
-        with Bar('Generating plot data', max=len(rawdict)) as bar:
-            for item in rawdict:
-                data_dict['value'].append(item['value'])
-                data_dict['is_prime'].append('True' if item['is_prime'] else 'False')
-                prime_factors = self.parse_factors(item['prime_factors'])
-                data_dict['prime_factors'].append(prime_factors)
-                family_factors = prime_factors[:-1]
-                data_dict['small_factors'].append(family_factors)
-                data_dict['largest_factor'].append(prime_factors[-1])
-                data_dict['division_family'].append(item['division_family'])
-                data_dict['ideal_factor'].append(item['ideal_factor'])
-                data_dict['mean_deviation'].append(item['mean_deviation'])
-                data_dict['antislope'].append(item['antislope'])
-                data_dict['color_bucket'].append(str(binary_buckets[item[colorization_field]]))
-                bar.next()
+        return self.get_bucket_ids(color_data[colorization_field], bucket_boundaries)
+
+
+    def collection_to_df(self, data: pd.DataFrame, palette_range: int, colorization_field: str) -> pd.DataFrame:
+        if 'color_bucket' in data:
+            # assigned before sampling, over the full data
+            bucket_ids = data['color_bucket'].to_numpy()
+        else:
+            bucket_ids = self.assign_color_buckets(data)
+        if bucket_ids is None:
+            return None
+
+        step_start = datetime.utcnow()
+        factors, offsets = decode_prime_factors(data['prime_factors'])
+        starts = offsets[:-1].tolist()
+        ends = offsets[1:].tolist()
+        flat_factors = factors.tolist()
+        has_factors = offsets[1:] > offsets[:-1]
+        largest_factor = np.ones(len(data), dtype=np.int64)
+        largest_factor[has_factors] = factors[offsets[1:][has_factors] - 1]
+
+        data_dict = {}
+        data_dict['value'] = data['value'].to_numpy()
+        data_dict['is_prime'] = np.where(data['is_prime'].to_numpy(dtype=bool), 'True', 'False').tolist()
+        data_dict['prime_factors'] = [flat_factors[start:end] for start, end in zip(starts, ends)]
+        data_dict['small_factors'] = [flat_factors[start:end - 1] for start, end in zip(starts, ends)]
+        data_dict['largest_factor'] = largest_factor
+        data_dict['division_family'] = data['division_family'].to_numpy()
+        data_dict['ideal_factor'] = data['ideal_factor'].to_numpy()
+        data_dict['mean_deviation'] = data['mean_deviation'].to_numpy()
+        data_dict['antislope'] = data['antislope'].to_numpy()
+        data_dict['color_bucket'] = bucket_ids.astype(str).tolist()
 
         data_df = pd.DataFrame(data_dict)
+        step_end = datetime.utcnow()
+        self.logger.debug(f'Plot data generated in {step_end-step_start}')
+
+        return data_df
 
-        return data_df        
+
+    def sample_data(self, config: ConfigAgent, data: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Thin the data down to about plot.max_points rows
+
+        The minimum and maximum of the y metric in each of plot.sample_x_bins value bins are always kept,
+        so visible outliers survive; the rest of the budget is spread over the (color bucket, division family)
+        strata in proportion to their size, with at least one row per stratum, so rare strata are not lost
+        Color buckets are assigned over the full data before sampling and kept in a color_bucket column
+        '''
+        max_points = config.plot.max_points
+        if max_points <= 0 or len(data) <= max_points:
+            return data
+
+        step_start = datetime.utcnow()
+        bucket_ids = self.assign_color_buckets(data)
+        if bucket_ids is None:
+            return data
+        data = data.assign(color_bucket=bucket_ids)
+        keep = np.zeros(len(data), dtype=bool)
+
+        # extrema of the y metric per value bin
+        x_values = data['value'].to_numpy()
+        y_values = data[mappings.y_axis_values[config.plot.mode]].to_numpy()
+        x_bins = (x_values - x_values.min()) * config.plot.sample_x_bins // (x_values.max() - x_values.min() + 1)
+        order = np.lexsort((y_values, x_bins))
+        bin_starts = np.flatnonzero(np.diff(x_bins[order], prepend=-1))
+        bin_ends = np.append(bin_starts[1:], len(order)) - 1
+        keep[order[bin_starts]] = True
+        keep[order[bin_ends]] = True
+
+        # proportional stratified sample of the remaining rows
+        strata = data.groupby(['color_bucket', 'division_family'], sort=False).ngroup().to_numpy()
+        candidates = np.flatnonzero(~keep)
+        budget = max(max_points - int(keep.sum()), 0)
+        stratum_sizes = np.bincount(strata[candidates], minlength=strata.max() + 1)
+        allocation = np.minimum(np.maximum(stratum_sizes * budget // max(len(candidates), 1), 1), stratum_sizes)
+        shuffled = np.random.default_rng(0).permutation(candidates)
+        shuffled = shuffled[np.argsort(strata[shuffled], kind='stable')]
+        shuffled_strata = strata[shuffled]
+        stratum_starts = np.concatenate(([0], np.cumsum(stratum_sizes)[:-1]))
+        rank_in_stratum = np.arange(len(shuffled)) - stratum_starts[shuffled_strata]
+        keep[shuffled[rank_in_stratum < allocation[shuffled_strata]]] = True
+
+        sampled_df = data[keep]
+        step_end = datetime.utcnow()
+        self.logger.info(f'Sampled {len(sampled_df)} of {len(data)} points')
+        self.logger.debug(f'...done in {step_end-step_start}')
+
+        return sampled_df
 
 
     def prepare_data(self, config: ConfigAgent, data: pd.DataFrame) -> pd.DataFrame:
@@ -502,15 +858,32 @@ class Processor():
         return data_df
 
     def plot(self):
+        html_filepath = self.cfg.local.html_filepath
+        project_title = self.cfg.local.project_title
+        if self.cfg.plot.render == 'tiles':
+            self.serve_tiled_plot(self.logger, self.cfg, self.data_manager, project_title, html_filepath)
+            return
+
+        if self.cfg.plot.render == 'raster':
+            from bokeh.plotting import show
+
+            # the raster only needs the coordinates and the colorization field
+            columns = ['value', mappings.y_axis_values[self.cfg.plot.mode], mappings.colorization_field[self.cfg.plot.colorization_value]]
+            data = self.get_data(self.logger, self.cfg, self.data_manager, columns)
+            self.logger.info('Rasterizing data')
+            plot = self.generate_raster_plot(self.logger, self.cfg, data, project_title, html_filepath)
+            show(plot)
+            self.logger.info('Displaying plot')
+            return
+
         data = self.get_data(self.logger, self.cfg, self.data_manager)
+        data = self.sample_data(self.cfg, data)
 
         # prepare data for plot
         self.logger.info('Preparing data')
         data = self.prepare_data(self.cfg, data)
 
         # plot data
-        html_filepath = self.cfg.local.html_filepath
-        project_title = self.cfg.local.project_title
         plot = self.generate_plot(self.logger, self.cfg, data, project_title, html_filepath)
 
         plot.display_plot()
@@ -520,7 +893,10 @@ class Processor():
         self.logger.info(f'Start at {self.cfg.local.start}')
         self.log_settings()
         mode = self.cfg.mode.mode
-        if mode == 'generate':
+        if mode == 'convert':
+            self.convert()
+            logger_filename_prefix = 'CONVERT'
+        elif mode == 'generate':
             self.generate()
             logger_filename_prefix = 'GEN'
         else:
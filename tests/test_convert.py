@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+
+from toolbox.column_store import ColumnStore
+from toolbox.data_manager import DataManager, convert_sqlite_store
+from toolbox.generator import Decomposer
+from toolbox.metrics import compile_columns
+from toolbox.parquet_store import ParquetDataManager
+from toolbox.sieve import SmallestPrimeFactorTable
+
+VALUE_COUNT = 8000
+
+
+def make_db(db_filepath: str):
+    values = np.arange(2, VALUE_COUNT + 2, dtype=np.int64)
+    values, is_prime, factors, counts = Decomposer(SmallestPrimeFactorTable(VALUE_COUNT + 1)).factor_chunk(values)
+    DataManager(db_filepath).save_data(pd.DataFrame(compile_columns(values, is_prime, factors, counts)))
+
+
+def assert_converts_once(db_filepath: str, target):
+    convert_sqlite_store(db_filepath, target, window_size=3000)
+    convert_sqlite_store(db_filepath, target, window_size=3000)
+    assert target.get_column_bounds('value') == (2, VALUE_COUNT + 1, VALUE_COUNT)
+    stored = target.load_value_range(2, VALUE_COUNT + 1)
+    assert stored['value'].tolist() == list(range(2, VALUE_COUNT + 2))
+
+
+def test_converting_twice_into_parquet(tmp_path):
+    db_filepath = str(tmp_path / 'composites.db')
+    make_db(db_filepath)
+    assert_converts_once(db_filepath, ParquetDataManager(str(tmp_path / 'composites'), 5000))
+
+
+def test_converting_twice_into_columns(tmp_path):
+    db_filepath = str(tmp_path / 'composites.db')
+    make_db(db_filepath)
+    assert_converts_once(db_filepath, ColumnStore(str(tmp_path / 'composites_columns')))
@@ -0,0 +1,56 @@
+import numpy as np
+import pyprimes as pp
+
+from toolbox.generator import Decomposer
+from toolbox.metrics import compile_columns, compile_record
+from toolbox.sieve import SmallestPrimeFactorTable
+
+# the sieve table covers [0..TABLE_LIMIT]; the values above it go through the pyprimes fallback
+TABLE_LIMIT = 2000000
+FALLBACK_COUNT = 2000
+CHUNK_SIZE = 100000
+
+
+def assert_parity(values: np.ndarray, is_prime: np.ndarray, factors: np.ndarray, counts: np.ndarray):
+    '''
+    Check the kernel columns against compile_record, value by value, bit for bit
+    '''
+    columns = compile_columns(values, is_prime, factors, counts)
+    for row, (value, prime, prime_factors) in enumerate(zip(values.tolist(), is_prime.tolist(), columns['prime_factors'])):
+        record = compile_record(value, prime, prime_factors)
+        assert record['prime_factors'] == prime_factors, value
+        for metric in ['ideal_factor', 'mean_deviation', 'antislope', 'division_family']:
+            # float equality on purpose: the kernel promises the exact same bits
+            assert columns[metric][row] == record[metric], (value, metric, columns[metric][row], record[metric])
+
+
+def test_kernel_matches_records_over_the_table():
+    decomposer = Decomposer(SmallestPrimeFactorTable(TABLE_LIMIT))
+    for chunk_start in range(1, TABLE_LIMIT + 1, CHUNK_SIZE):
+        values = np.arange(chunk_start, min(chunk_start + CHUNK_SIZE, TABLE_LIMIT + 1), dtype=np.int64)
+        assert_parity(*decomposer.factor_chunk(values))
+
+
+def test_kernel_matches_records_above_the_table():
+    decomposer = Decomposer(SmallestPrimeFactorTable(TABLE_LIMIT))
+    values = np.arange(TABLE_LIMIT + 1, TABLE_LIMIT + 1 + FALLBACK_COUNT, dtype=np.int64)
+    values, is_prime, factors, counts = decomposer.factor_chunk(values)
+    for value, prime, row, count in zip(values.tolist(), is_prime.tolist(), factors.tolist(), counts.tolist()):
+        assert prime == pp.isprime(value)
+        assert row[:count] == sorted(pp.factors(value))
+    assert_parity(values, is_prime, factors, counts)
+
+
+def test_edge_cases():
+    # 1, primes, prime powers (all factors equal) and mixed composites, inside and above the table
+    values = np.array([1, 2, 3, 4, 8, 9, 12, 30, 97, 1024, 3 ** 12, 7919 ** 2, 999983,
+                       TABLE_LIMIT + 11, 2 ** 22, 1000003 ** 2, 2 * 1000003], dtype=np.int64)
+    values, is_prime, factors, counts = Decomposer(SmallestPrimeFactorTable(TABLE_LIMIT)).factor_chunk(values)
+    assert counts.tolist()[:4] == [0, 1, 1, 2]
+    assert is_prime.tolist()[:4] == [False, True, True, False]
+    columns = compile_columns(values, is_prime, factors, counts)
+    assert columns['ideal_factor'][0] == 0 and columns['division_family'][0] == 1
+    # prime powers have no deviation, so no antislope
+    for row in [3, 4, 5, 9, 10, 11, 14, 15]:
+        assert columns['mean_deviation'][row] == 0 and columns['antislope'][row] == 0
+    assert_parity(values, is_prime, factors, counts)
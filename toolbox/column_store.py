@@ -0,0 +1,287 @@
+import json
+import os
+import threading
+import time
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+
+from toolbox.factor_codec import FACTOR_DTYPE, split_blob
+
+COLUMNS = ['value', 'is_prime', 'ideal_factor', 'prime_factors', 'mean_deviation', 'antislope', 'division_family']
+METRIC_DTYPES = {
+    'ideal_factor': np.float64,
+    'mean_deviation': np.float64,
+    'antislope': np.float64,
+    'division_family': np.int64,
+}
+# packed bitmaps, one bit per row
+FLAGS = ['stored', 'is_prime']
+
+
+class ColumnStore():
+    '''
+    Keeps the composites as flat column files, memory-mapped, where the row of a value is value - base
+
+    Every metric is one .npy file, the stored and is_prime flags are packed bitmaps, and the
+    factors are a pair of files: one append-only pool of factors and the (start, end) of each row in it
+    Loading a range of values slices the mapped files; nothing is read until it is used
+
+    Growing the store writes a new generation of files next to the current one; replacing store.json
+    switches over to it, so a run killed mid-grow leaves the previous generation intact
+    '''
+
+    METADATA_FILENAME = 'store.json'
+
+    def __init__(self, folder: str, logger=None) -> None:
+        self.folder = folder
+        self.logger = logger
+        self.metadata = None
+        self.columns = {}
+        # saves may run on a writer thread while the run looks up stored values; growing the files remaps them
+        self.lock = threading.RLock()
+        metadata_filepath = os.path.join(folder, self.METADATA_FILENAME)
+        if os.path.exists(metadata_filepath):
+            with open(metadata_filepath) as metadata_file:
+                self.metadata = json.load(metadata_file)
+            self.remove_stale_files()
+            self.open_columns()
+
+
+    def get_filepath(self, name: str, generation: int = None) -> str:
+        if generation is None:
+            generation = self.metadata.get('generation', 0)
+        # stores written before generations were kept use plain file names
+        suffix = f'.{generation}' if generation > 0 else ''
+        return os.path.join(self.folder, f'{name}{suffix}.npy')
+
+
+    def remove_stale_files(self):
+        '''
+        Remove the files of other generations and half-written metadata, left over by an interrupted run
+        '''
+        current_files = {os.path.basename(self.get_filepath(name)) for name in self.get_shapes(0, 0)}
+        for filename in os.listdir(self.folder):
+            if filename.endswith('.tmp') or (filename.endswith('.npy') and filename not in current_files):
+                try:
+                    os.remove(os.path.join(self.folder, filename))
+                except OSError:
+                    # still mapped by an earlier frame; the next open removes it
+                    pass
+
+
+    def get_shapes(self, capacity: int, factor_capacity: int) -> dict:
+        shapes = {name: ((capacity,), dtype) for name, dtype in METRIC_DTYPES.items()}
+        shapes.update({name: ((capacity // 8,), np.uint8) for name in FLAGS})
+        shapes['factor_spans'] = ((capacity, 2), np.int64)
+        shapes['factors'] = ((factor_capacity,), FACTOR_DTYPE)
+        return shapes
+
+
+    def open_columns(self):
+        self.columns = {name: np.load(self.get_filepath(name), mmap_mode='r+')
+                        for name in self.get_shapes(0, 0)}
+
+
+    def write_metadata(self):
+        metadata_filepath = os.path.join(self.folder, self.METADATA_FILENAME)
+        with open(metadata_filepath + '.tmp', 'w') as metadata_file:
+            json.dump(self.metadata, metadata_file, indent=4)
+        os.replace(metadata_filepath + '.tmp', metadata_filepath)
+
+
+    def reserve(self, lower: int, upper: int, factor_count: int):
+        '''
+        Grow the files so the values in [lower..upper] and factor_count more factors fit
+
+        Rows grow by at least the current capacity and the factor pool at least doubles, so repeated saves
+        copy every file only a logarithmic number of times; base and capacity stay multiples of 8 for the bitmaps
+        '''
+        if self.metadata is None:
+            os.makedirs(self.folder, exist_ok=True)
+            base = lower - lower % 8
+            self.metadata = {'base': base, 'capacity': 0, 'factor_count': 0, 'factor_capacity': 0, 'generation': 0}
+            for name, (shape, dtype) in self.get_shapes(0, 0).items():
+                np.lib.format.open_memmap(self.get_filepath(name), mode='w+', dtype=dtype, shape=shape)
+        base = self.metadata['base']
+        capacity = self.metadata['capacity']
+        factor_capacity = self.metadata['factor_capacity']
+        new_base = min(base, lower - lower % 8)
+        new_end = base + capacity
+        if upper >= new_end:
+            new_end = max(upper + 1, base + 2 * capacity)
+        new_end += -new_end % 8
+        new_factor_capacity = factor_capacity
+        if self.metadata['factor_count'] + factor_count > factor_capacity:
+            new_factor_capacity = max(self.metadata['factor_count'] + factor_count, 2 * factor_capacity)
+        if (new_base, new_end, new_factor_capacity) == (base, base + capacity, factor_capacity):
+            return
+
+        # rows move by whole bytes of the bitmaps
+        shift = base - new_base
+        new_shapes = self.get_shapes(new_end - new_base, new_factor_capacity)
+        generation = self.metadata.get('generation', 0)
+        self.columns = {}
+        for name, (shape, dtype) in new_shapes.items():
+            old_column = np.load(self.get_filepath(name, generation), mmap_mode='r')
+            new_column = np.lib.format.open_memmap(self.get_filepath(name, generation + 1), mode='w+', dtype=dtype, shape=shape)
+            if name == 'factors':
+                new_column[:len(old_column)] = old_column
+            elif name in FLAGS:
+                new_column[shift // 8:shift // 8 + len(old_column)] = old_column
+            else:
+                new_column[shift:shift + len(old_column)] = old_column
+            new_column.flush()
+            del old_column, new_column
+        # the new generation is only in use once store.json names it
+        self.metadata.update({'base': new_base, 'capacity': new_end - new_base, 'factor_capacity': new_factor_capacity,
+                              'generation': generation + 1})
+        self.write_metadata()
+        self.remove_stale_files()
+        self.open_columns()
+
+
+    def set_flags(self, name: str, rows: np.ndarray, flags: np.ndarray):
+        bitmap = self.columns[name]
+        bits = (128 >> (rows & 7)).astype(np.uint8)
+        np.bitwise_or.at(bitmap, rows[flags] >> 3, bits[flags])
+        np.bitwise_and.at(bitmap, rows[~flags] >> 3, ~bits[~flags])
+
+
+    def get_flags(self, name: str, rows: np.ndarray) -> np.ndarray:
+        return (self.columns[name][rows >> 3] & (128 >> (rows & 7))) > 0
+
+
+    def get_flag_range(self, name: str, lower_row: int, upper_row: int) -> np.ndarray:
+        bits = np.unpackbits(self.columns[name][lower_row >> 3:(upper_row >> 3) + 1])
+        return bits[lower_row & 7:(lower_row & 7) + upper_row - lower_row + 1].astype(bool)
+
+
+    def save_data(self, data: pd.DataFrame):
+        '''Saves the data into the rows of its values; the factors are appended to the pool'''
+        with self.lock:
+            self.write_data(data)
+
+
+    def write_data(self, data: pd.DataFrame):
+        start = time.perf_counter()
+        values = data['value'].to_numpy(dtype=np.int64)
+        if len(values) == 0:
+            return
+        prime_factors = data['prime_factors'].tolist()
+        counts = np.fromiter(map(len, prime_factors), dtype=np.int64, count=len(prime_factors))
+        flat_factors = np.fromiter(chain.from_iterable(prime_factors), dtype=FACTOR_DTYPE, count=int(counts.sum()))
+        self.reserve(int(values.min()), int(values.max()), len(flat_factors))
+
+        rows = values - self.metadata['base']
+        factor_start = self.metadata['factor_count']
+        self.columns['factors'][factor_start:factor_start + len(flat_factors)] = flat_factors
+        factor_ends = factor_start + np.cumsum(counts)
+        self.columns['factor_spans'][rows, 0] = factor_ends - counts
+        self.columns['factor_spans'][rows, 1] = factor_ends
+        for name, dtype in METRIC_DTYPES.items():
+            self.columns[name][rows] = data[name].to_numpy(dtype=dtype)
+        self.set_flags('is_prime', rows, data['is_prime'].to_numpy(dtype=bool))
+        for column in self.columns.values():
+            column.flush()
+        self.metadata['factor_count'] = factor_start + len(flat_factors)
+        self.write_metadata()
+        # rows count as stored only once their data and factors are on disk
+        self.set_flags('stored', rows, np.ones(len(rows), dtype=bool))
+        self.columns['stored'].flush()
+
+        elapsed = time.perf_counter() - start
+        if self.logger is not None and elapsed > 0:
+            self.logger.debug(f'{len(data)} rows written in {elapsed:.2f}s ({len(data) / elapsed:.0f} rows/s)')
+
+
+    def get_frame(self, rows, columns: list = None) -> pd.DataFrame:
+        '''
+        Build a dataframe of the given rows, either a slice (the column data is not copied) or an array of row numbers
+        '''
+        columns = columns or COLUMNS
+        if self.metadata is None:
+            empty_dtypes = {'value': np.int64, 'is_prime': bool, 'prime_factors': object, **METRIC_DTYPES}
+            return pd.DataFrame({column: np.zeros(0, dtype=empty_dtypes[column]) for column in columns})
+        row_numbers = np.arange(rows.start, rows.stop, dtype=np.int64) if isinstance(rows, slice) else rows
+        frame_data = {}
+        for column in columns:
+            if column == 'value':
+                frame_data[column] = row_numbers + self.metadata['base']
+            elif column == 'is_prime':
+                frame_data[column] = self.get_flags('is_prime', row_numbers)
+            elif column == 'prime_factors':
+                spans = self.columns['factor_spans'][rows]
+                counts = spans[:, 1] - spans[:, 0]
+                # gather every row's factors into one buffer, then cut it into per-row blobs
+                positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - spans[:, 0], counts)
+                frame_data[column] = split_blob(self.columns['factors'][positions].tobytes(), counts)
+            else:
+                frame_data[column] = self.columns[column][rows]
+        return pd.DataFrame(frame_data, copy=False)
+
+
+    def load_data(self, value_list, exclude_primes: bool = False, columns: list = None) -> pd.DataFrame:
+        '''Loads raw data, corresponding to a list of int values, optionally only some columns'''
+        columns = list(dict.fromkeys(['value'] + columns)) if columns else None
+        with self.lock:
+            return self.read_rows(value_list, exclude_primes, columns)
+
+
+    def read_rows(self, value_list, exclude_primes: bool, columns: list) -> pd.DataFrame:
+        if self.metadata is None:
+            return self.get_frame(None, columns)
+        rows = np.unique(np.asarray(value_list, dtype=np.int64)) - self.metadata['base']
+        rows = rows[(rows >= 0) & (rows < self.metadata['capacity'])]
+        selected = self.get_flags('stored', rows)
+        if exclude_primes:
+            selected &= ~self.get_flags('is_prime', rows)
+        rows = rows[selected]
+        if len(rows) > 0 and rows[-1] - rows[0] + 1 == len(rows):
+            # a dense run of rows is sliced instead of gathered
+            rows = slice(int(rows[0]), int(rows[-1]) + 1)
+        return self.get_frame(rows, columns)
+
+
+    def load_value_data(self, value_list) -> pd.DataFrame:
+        '''Loads value data, corresponding to a list of int values'''
+        return self.load_data(value_list, columns=['value'])
+
+
+    def load_value_range(self, lower: int, upper: int, columns: list = None, exclude_primes: bool = False) -> pd.DataFrame:
+        '''Loads raw data for all values in [lower..upper], optionally only some columns'''
+        with self.lock:
+            if self.metadata is None:
+                return self.get_frame(None, columns)
+            lower_row = max(lower - self.metadata['base'], 0)
+            upper_row = min(upper - self.metadata['base'], self.metadata['capacity'] - 1)
+            if lower_row > upper_row:
+                return self.get_frame(slice(0, 0), columns)
+            selected = self.get_flag_range('stored', lower_row, upper_row)
+            if exclude_primes:
+                selected &= ~self.get_flag_range('is_prime', lower_row, upper_row)
+            if selected.all():
+                return self.get_frame(slice(lower_row, upper_row + 1), columns)
+            return self.get_frame(np.flatnonzero(selected) + lower_row, columns)
+
+
+    def get_column_bounds(self, column: str = 'value', exclude_primes: bool = False, window_size: int = 1 << 24) -> tuple:
+        '''Gets the smallest and largest stored values of a column and the number of stored rows'''
+        lower = None
+        upper = None
+        count = 0
+        if self.metadata is None:
+            return lower, upper, count
+        for lower_row in range(0, self.metadata['capacity'], window_size):
+            upper_row = min(lower_row + window_size, self.metadata['capacity']) - 1
+            selected = self.get_flag_range('stored', lower_row, upper_row)
+            if exclude_primes:
+                selected &= ~self.get_flag_range('is_prime', lower_row, upper_row)
+            if not selected.any():
+                continue
+            window = self.get_frame(np.flatnonzero(selected) + lower_row, [column])[column]
+            lower = window.min() if lower is None else min(lower, window.min())
+            upper = window.max() if upper is None else max(upper, window.max())
+            count += len(window)
+        return (lower.item() if lower is not None else None), (upper.item() if upper is not None else None), count
@@ -1,12 +1,23 @@
 import math
+import threading
+import time
 from sqlite3 import OperationalError
+import numpy as np
 import pandas as pd
 from progress.bar import Bar
-from sqlalchemy import Boolean, Column, Float, Integer, String, create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy import (Boolean, Column, Float, Integer, LargeBinary, and_, create_engine, func, insert, or_,
+                        select, text)
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.types import TypeDecorator
+
+from toolbox.factor_codec import decode_prime_factor_lists, encode_prime_factors, encode_prime_factors_column
+from toolbox.value_spans import get_value_spans
 
 Base = declarative_base()
 
+# connection settings for bulk loading: fewer syncs, a 64 MB page cache and temporary tables in memory
+BULK_LOAD_PRAGMAS = {'synchronous': 'NORMAL', 'cache_size': -65536, 'temp_store': 'MEMORY'}
+
 
 '''
 filter = {
@@ -28,6 +39,15 @@ alternative filtering at
 # LINK https://www.peterspython.com/en/blog/slqalchemy-dynamic-query-building-and-filtering-including-soft-deletes
 '''
 
+class PrimeFactors(TypeDecorator):
+    '''Packed little-endian int64 prime factors; strings from older dbs are read as they are'''
+    impl = LargeBinary
+    cache_ok = True
+
+    def result_processor(self, dialect, coltype):
+        return None
+
+
 class Value(Base):
     __tablename__ = "values"
     value = Column("value", Integer, primary_key=True)
@@ -42,7 +62,7 @@ class Composite(Base):
     value = Column("value", Integer, primary_key=True)
     is_prime = Column("is_prime", Boolean)
     ideal_factor = Column("ideal_factor", Float)
-    prime_factors = Column("prime_factors", String)
+    prime_factors = Column("prime_factors", PrimeFactors)
     mean_deviation = Column("mean_deviation", Float)
     antislope = Column("antislope", Float)
     division_family = Column("division_family", Integer)
@@ -53,15 +73,11 @@ class Composite(Base):
         self.value = number_dict['value']
         self.is_prime = number_dict['is_prime']
         self.ideal_factor = number_dict['ideal_factor']
-        self.prime_factors = self.compile_prime_factor_string(number_dict['prime_factors'])
+        self.prime_factors = encode_prime_factors(number_dict['prime_factors'])
         self.mean_deviation = number_dict['mean_deviation']
         self.antislope = number_dict['antislope']
         self.division_family = number_dict['division_family']
 
-    def compile_prime_factor_string(self, prime_factors: list) -> str:
-        pf_string = ",".join([str(value) for value in prime_factors])
-        return pf_string
-
 
 class DataManager():
     '''Governs the persistence and filtering of data'''
@@ -73,11 +89,55 @@ class DataManager():
     #     EQL = auto()
 
 
-    def __init__(self, db_filepath):
-        self.engine = create_engine(f"sqlite:///{db_filepath}")
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+    def __init__(self, db_filepath, logger=None, insert_batch_size: int = 50000, use_wal: bool = False):
+        self.db_filepath = db_filepath
+        self.insert_batch_size = insert_batch_size
+        self.use_wal = use_wal
+        # the engine is created on first use, possibly from the writer thread
+        self._engine = None
+        self.connect_lock = threading.Lock()
         self.filters = []
+        self.logger = logger
+
+
+    @property
+    def engine(self):
+        with self.connect_lock:
+            if self._engine is None:
+                self._engine = create_engine(f"sqlite:///{self.db_filepath}")
+        return self._engine
+
+
+    def enable_wal(self, connection):
+        '''
+        Switch the data file to write-ahead logging, so bulk loads do not block readers
+
+        The journal mode is stored in the data file itself and adds -wal and -shm files next to it,
+        so it is only switched when use_wal is set; switching a file already in WAL mode changes nothing
+        '''
+        journal_mode = connection.exec_driver_sql('PRAGMA journal_mode=WAL').scalar()
+        if self.logger is not None:
+            self.logger.debug(f'sqlite journal mode: {journal_mode}')
+
+
+    @staticmethod
+    def tune_for_load(connection) -> dict:
+        '''
+        Relax the durability and enlarge the caches of a connection for bulk loading
+
+        Returns the previous settings, for restore_tuning
+        '''
+        previous = {pragma: connection.exec_driver_sql(f'PRAGMA {pragma}').scalar() for pragma in BULK_LOAD_PRAGMAS}
+        for pragma, setting in BULK_LOAD_PRAGMAS.items():
+            connection.exec_driver_sql(f'PRAGMA {pragma}={setting}')
+        return previous
+
+
+    @staticmethod
+    def restore_tuning(connection, previous: dict):
+        '''Put back the settings of a pooled connection, so later reads do not inherit the bulk load ones'''
+        for pragma, setting in previous.items():
+            connection.exec_driver_sql(f'PRAGMA {pragma}={setting}')
 
 
     # def data_already_exists(self, config):
@@ -89,66 +149,131 @@ class DataManager():
 
 
     def save_data(self, data: pd.DataFrame):
-        '''Saves the data via sqlalchemy'''
+        '''Saves the data in batches of core inserts, one transaction per batch, on one connection tuned for loading'''
         Base.metadata.create_all(bind=self.engine)
-        Session = sessionmaker(bind=self.engine)
-        session = Session()
-        data_list = data.to_dict(orient="records")
-
-        # Bulk insert version
-        with Bar('Adding records to db', max=len(data_list)) as bar:
-            numbers = []
-            values = []
-            for record in data_list:
-                new_number = Composite(record)
-                numbers.append(new_number)
-                new_value = Value(record['value'])
-                values.append(new_value)
-                bar.next()
-        session.add_all(numbers)
-        session.add_all(values)
-        session.commit()
-
-
-    def split_value_list(self, value_list, limit):
-        cutoff_divisor = math.ceil(len(value_list)/limit)
-        cutoff = int(len(value_list)/cutoff_divisor)
-        value_batches = [value_list[:cutoff], value_list[cutoff:]]
-        return value_batches
-
-
-    def load_data(self, value_list):
-        '''Loads raw data, corresponding to a list of int values'''
-        limit = 200000
-        if len(value_list) > limit:
-            data_batches = []
-            value_list_batches = self.split_value_list(value_list, limit)
-            for counter in range(len(value_list_batches)):
-                values_batch = value_list_batches.pop()
-                data_batch = pd.read_sql(self.session.query(Composite).filter(Composite.value.in_(values_batch)).statement, self.session.bind)
-                data_batches.append(data_batch)
-            raw_df = pd.concat(data_batches)
-        else:
-            raw_df = pd.read_sql(self.session.query(Composite).filter(Composite.value.in_(value_list)).statement, self.session.bind)
+        batch_size = self.insert_batch_size
+        start = time.perf_counter()
+        batch_count = math.ceil(len(data) / batch_size)
+
+        with self.engine.connect() as connection, Bar('Adding records to db', max=batch_count) as bar:
+            if self.use_wal:
+                self.enable_wal(connection)
+            previous_tuning = self.tune_for_load(connection)
+            connection.commit()
+            try:
+                self.insert_batches(connection, data, batch_size, bar)
+            finally:
+                self.restore_tuning(connection, previous_tuning)
+                connection.commit()
+
+        elapsed = time.perf_counter() - start
+        if self.logger is not None and elapsed > 0:
+            self.logger.debug(f'{len(data)} rows written in {elapsed:.2f}s ({len(data) / elapsed:.0f} rows/s)')
+
+
+    @staticmethod
+    def insert_batches(connection, data: pd.DataFrame, batch_size: int, bar: Bar):
+        composites_table = Composite.__table__
+        values_table = Value.__table__
+        for batch_start in range(0, len(data), batch_size):
+            batch = data.iloc[batch_start: batch_start + batch_size]
+            values = batch['value'].tolist()
+            prime_factors = encode_prime_factors_column(batch['prime_factors'].tolist())
+            composite_rows = [
+                {
+                    'value': value,
+                    'is_prime': is_prime,
+                    'ideal_factor': ideal_factor,
+                    'prime_factors': factors,
+                    'mean_deviation': mean_deviation,
+                    'antislope': antislope,
+                    'division_family': division_family
+                }
+                for value, is_prime, ideal_factor, factors, mean_deviation, antislope, division_family in zip(
+                    values,
+                    batch['is_prime'].tolist(),
+                    batch['ideal_factor'].tolist(),
+                    prime_factors,
+                    batch['mean_deviation'].tolist(),
+                    batch['antislope'].tolist(),
+                    batch['division_family'].tolist())
+            ]
+            value_rows = [{'value': value} for value in values]
+            with connection.begin():
+                connection.execute(insert(composites_table), composite_rows)
+                connection.execute(insert(values_table), value_rows)
+            bar.next()
+
+
+    def load_rows(self, table, value_list, exclude_primes: bool = False, columns: list = None, max_spans: int = 1000, spans_per_query: int = 100) -> pd.DataFrame:
+        '''
+        Loads the rows of a table, corresponding to a list of int values, optionally only some columns
+
+        Lists that fall into a few dense spans (e.g. a range, with or without primes) are loaded
+        with BETWEEN predicates; scattered lists are joined against a temporary table
+        '''
+        column_names = list(dict.fromkeys(['value'] + columns)) if columns else [column.name for column in table.columns]
+        selected = [table.c[column] for column in column_names]
+        values, span_starts, span_ends = get_value_spans(value_list)
+        if len(values) == 0:
+            return pd.read_sql(select(*selected).where(text('0')), self.engine)
+
+        with self.engine.connect() as connection:
+            if len(span_starts) <= max_spans:
+                data_batches = []
+                for batch_start in range(0, len(span_starts), spans_per_query):
+                    spans = zip(span_starts[batch_start: batch_start + spans_per_query].tolist(),
+                                span_ends[batch_start: batch_start + spans_per_query].tolist())
+                    predicate = or_(*[table.c.value.between(span_start, span_end) for span_start, span_end in spans])
+                    if exclude_primes:
+                        predicate = and_(predicate, table.c.is_prime == False)
+                    data_batches.append(pd.read_sql(select(*selected).where(predicate), connection))
+                raw_df = pd.concat(data_batches, ignore_index=True)
+                # spans may hold values that were not requested
+                raw_df = raw_df[np.isin(raw_df['value'].to_numpy(), values)].reset_index(drop=True)
+            else:
+                connection.exec_driver_sql('CREATE TEMP TABLE IF NOT EXISTS requested_values (value INTEGER PRIMARY KEY)')
+                connection.exec_driver_sql('DELETE FROM requested_values')
+                connection.exec_driver_sql('INSERT INTO requested_values (value) VALUES (?)', [(value,) for value in values.tolist()])
+                selected_columns = ', '.join(f'"{table.name}"."{column}"' for column in column_names)
+                query = f'SELECT {selected_columns} FROM "{table.name}" JOIN requested_values ON "{table.name}".value = requested_values.value'
+                if exclude_primes:
+                    query += f' WHERE NOT "{table.name}".is_prime'
+                raw_df = pd.read_sql(text(query), connection)
+                connection.exec_driver_sql('DROP TABLE requested_values')
 
         return raw_df
 
 
+    def load_data(self, value_list, exclude_primes: bool = False, columns: list = None):
+        '''Loads raw data, corresponding to a list of int values, optionally only some columns'''
+        return self.load_rows(Composite.__table__, value_list, exclude_primes, columns)
+
+
     def load_value_data(self, value_list):
         '''Loads value data, corresponding to a list of int values'''
-        limit = 200000
-        if len(value_list) > limit:
-            data_batches = []
-            value_list_batches = self.split_value_list(value_list, limit)
-            for counter in range(len(value_list_batches)):
-                values_batch = value_list_batches.pop()
-                data_batch = pd.read_sql(self.session.query(Value).filter(Value.value.in_(values_batch)).statement, self.session.bind)
-                data_batches.append(data_batch)
-            raw_df = pd.concat(data_batches)
-        else:
-            raw_df = pd.read_sql(self.session.query(Value).filter(Value.value.in_(value_list)).statement, self.session.bind)
+        return self.load_rows(Value.__table__, value_list)
+
+
+    def load_value_range(self, lower: int, upper: int, columns: list = None, exclude_primes: bool = False) -> pd.DataFrame:
+        '''Loads raw data for all values in [lower..upper], optionally only some columns'''
+        table = Composite.__table__
+        selected = [table.c[column] for column in columns] if columns else [table]
+        predicate = table.c.value.between(lower, upper)
+        if exclude_primes:
+            predicate = and_(predicate, table.c.is_prime == False)
+        return pd.read_sql(select(*selected).where(predicate).order_by(table.c.value), self.engine)
 
-        return raw_df
+
+    def get_column_bounds(self, column: str = 'value', exclude_primes: bool = False) -> tuple:
+        '''Gets the smallest and largest stored values of a column and the number of stored rows'''
+        table = Composite.__table__
+        query = select(func.min(table.c[column]), func.max(table.c[column]), func.count())
+        if exclude_primes:
+            query = query.where(table.c.is_prime == False)
+        with self.engine.connect() as connection:
+            lower, upper, count = connection.execute(query).one()
+        return lower, upper, count
 
 
     def set_data(self, data: pd.DataFrame):
@@ -241,3 +366,29 @@ class DataManager():
 
     #     return True
 
+
+def convert_sqlite_store(db_filepath: str, target, window_size: int = 1000000, logger=None):
+    '''
+    Copy the composites of a sqlite data file into another data backend, window by window
+
+    Values the target already holds are skipped, so converting again (or after an interrupted run) adds no duplicates
+    '''
+    source = DataManager(db_filepath, logger)
+    lower, upper, row_count = source.get_column_bounds('value')
+    if row_count == 0:
+        if logger is not None:
+            logger.info('There is no data to convert')
+        return
+    for window_start in range(lower, upper + 1, window_size):
+        window_end = min(window_start + window_size - 1, upper)
+        window_df = source.load_value_range(window_start, window_end)
+        stored_values = target.load_value_range(window_start, window_end, columns=['value'])['value'].to_numpy()
+        if len(stored_values) > 0:
+            window_df = window_df[~np.isin(window_df['value'].to_numpy(), stored_values)].reset_index(drop=True)
+        if len(window_df) == 0:
+            continue
+        # older dbs hold factors as strings; the stores only keep packed factors
+        window_df['prime_factors'] = decode_prime_factor_lists(window_df['prime_factors'])
+        target.save_data(window_df)
+        if logger is not None:
+            logger.debug(f'[{window_start}..{window_end}] {len(window_df)} rows converted')
@@ -0,0 +1,73 @@
+from itertools import chain
+
+import numpy as np
+
+'''
+prime_factors storage format
+
+Factors are stored as packed little-endian int64 values, 8 bytes per factor,
+in factor order; value 1 (no factors) is an empty blob
+Older dbs hold comma-joined strings ("2,3,5"); the decoders read both
+'''
+
+FACTOR_DTYPE = np.dtype('<i8')
+
+
+def encode_prime_factors(prime_factors) -> bytes:
+    return np.asarray(prime_factors, dtype=FACTOR_DTYPE).tobytes()
+
+
+def encode_prime_factors_column(prime_factors_column) -> list[bytes]:
+    '''
+    Encode a whole column of factor lists, packing all factors in one pass
+    '''
+    counts = np.fromiter(map(len, prime_factors_column), dtype=np.int64, count=len(prime_factors_column))
+    flat_factors = np.fromiter(chain.from_iterable(prime_factors_column), dtype=FACTOR_DTYPE, count=int(counts.sum()))
+    return split_blob(flat_factors.tobytes(), counts)
+
+
+def split_blob(blob: bytes, counts: np.ndarray) -> list[bytes]:
+    ends = (np.cumsum(counts) * FACTOR_DTYPE.itemsize).tolist()
+    starts = [0] + ends[:-1]
+    return [blob[start:end] for start, end in zip(starts, ends)]
+
+
+def decode_prime_factors(prime_factors_column) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Decode a column of stored prime factors in bulk
+
+    Accepts packed blobs, comma-joined strings or a mix of both
+    Returns the flat int64 factors and the offsets of each row (CSR form)
+    '''
+    entries = list(prime_factors_column)
+    is_blob = np.fromiter((isinstance(entry, (bytes, bytearray, memoryview)) for entry in entries), dtype=bool, count=len(entries))
+    counts = np.zeros(len(entries), dtype=np.int64)
+    blob_rows = np.flatnonzero(is_blob)
+    string_rows = np.flatnonzero(~is_blob)
+
+    blobs = [bytes(entries[row]) for row in blob_rows.tolist()]
+    counts[blob_rows] = [len(blob) // FACTOR_DTYPE.itemsize for blob in blobs]
+    blob_factors = np.frombuffer(b''.join(blobs), dtype=FACTOR_DTYPE).astype(np.int64)
+
+    strings = [entries[row] for row in string_rows.tolist()]
+    counts[string_rows] = [string.count(',') + 1 if string else 0 for string in strings]
+    joined = ','.join(string for string in strings if string)
+    string_factors = np.array(joined.split(',') if joined else [], dtype=np.int64)
+
+    offsets = np.zeros(len(entries) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    factors = np.empty(offsets[-1], dtype=np.int64)
+    for rows, source in ((blob_rows, blob_factors), (string_rows, string_factors)):
+        # place each row's factors at that row's offset
+        row_counts = counts[rows]
+        source_starts = np.cumsum(row_counts) - row_counts
+        positions = np.arange(len(source)) - np.repeat(source_starts, row_counts) + np.repeat(offsets[rows], row_counts)
+        factors[positions] = source
+
+    return factors, offsets
+
+
+def decode_prime_factor_lists(prime_factors_column) -> list[list[int]]:
+    factors, offsets = decode_prime_factors(prime_factors_column)
+    flat_factors = factors.tolist()
+    return [flat_factors[start:end] for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
@@ -0,0 +1,66 @@
+import math
+from itertools import chain
+
+import numpy as np
+import pyprimes as pp
+
+from toolbox.sieve import get_primes_between
+
+
+class FamilyEngine():
+    '''
+    Composites of number families
+
+    Every family yields its product times a first identity factor, then times each identity prime above it
+    The identity primes of all families are sieved in one pass and shared between the families
+    '''
+
+    def __init__(self, families: list[list[int]]) -> None:
+        self.families = [sorted(family) for family in families]
+        self.family_products = [math.prod(family) for family in self.families]
+        # members need not be prime; the product factors are what every family value shares
+        self.product_factors = [sorted(chain.from_iterable(pp.factors(member) for member in family if member > 1)) for family in self.families]
+
+    def get_primes_in_range(self, lower: int, upper: int) -> np.ndarray:
+        '''
+        Get the identity primes in (lower..upper]
+        '''
+        return get_primes_between(lower + 1, upper)
+
+    def get_primes_above(self, starts: list[int], count: int) -> list[np.ndarray]:
+        '''
+        Get the first count primes above each start, all from one sieve over [min(starts)..]
+        '''
+        lower = min(starts) + 1
+        upper = max(starts) + count * math.ceil(math.log(max(starts) + count + 2) * 1.2) + 64
+        while True:
+            primes = get_primes_between(lower, upper)
+            positions = np.searchsorted(primes, starts, side='right')
+            if (len(primes) - positions >= count).all():
+                break
+            # prime gaps ran wider than estimated; sieve further out
+            upper += upper - lower
+        return [primes[position:position + count] for position in positions.tolist()]
+
+    def get_family_values(self, family_index: int, identity_factors: np.ndarray) -> np.ndarray:
+        '''
+        Multiply the family product by an array of identity factors
+        '''
+        family_product = self.family_products[family_index]
+        if len(identity_factors) > 0 and family_product > np.iinfo(np.int64).max // int(identity_factors.max()):
+            raise ValueError(f'Values of family {self.families[family_index]} exceed the int64 range')
+        return np.int64(family_product) * identity_factors
+
+    def factor_family_values(self, family_index: int, identity_primes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Build the prime factors of family values from the known factors, without factoring the values
+
+        Every identity factor must be prime; returns a padded (n x width) array of sorted prime factors and the factor counts
+        '''
+        product_factors = self.product_factors[family_index]
+        factors = np.empty((len(identity_primes), len(product_factors) + 1), dtype=np.int64)
+        factors[:, :-1] = product_factors
+        factors[:, -1] = identity_primes
+        factors.sort(axis=1)
+        counts = np.full(len(identity_primes), factors.shape[1], dtype=np.int64)
+        return factors, counts
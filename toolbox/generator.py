@@ -1,91 +1,249 @@
 import math
 import multiprocessing
+import os
+import time
+from collections import deque
 from datetime import datetime
-from multiprocessing import Process, Queue
+from itertools import chain
+from typing import Optional, Union
 
+import numpy as np
 import pandas as pd
 import pyprimes as pp
 
+from toolbox.metrics import compile_columns, compile_records, compute_metrics, pad_factors
+from toolbox.sieve import SieveWindow, SmallestPrimeFactorTable, SpanSieve
+from toolbox.transport import SharedColumns, get_factor_capacity, release_blocks, share_resource_tracker
 
-class Decomposer(Process):
-    def __init__(self, queue, value_list):
-        Process.__init__(self)
-        self.queue = queue
-        self.value_list = value_list
-    
-    def get_ideal_factor(self, value: int, prime_factors: list[int]) -> float:
-        return math.pow(value, 1/len(prime_factors))
-
-    def get_mean_deviation(self, prime_factors: list[int], ideal_factor: float) -> float:
-        if all(x == prime_factors[0] for x in prime_factors):
-            return 0.0
-        deviations_sum = 0
-        for prime_factor in prime_factors:
-            deviations_sum += abs(prime_factor - ideal_factor)
-        mean_deviation = deviations_sum / len(prime_factors)
-
-        return mean_deviation
-
-    def run(self):
-        updated_collection = []
-        for value in self.value_list:
-            new_record = {}
-            new_record['value'] = value
-            new_record['is_prime'] = pp.isprime(int(value))
-            if new_record['value'] == 1:
-                new_record['ideal_factor'] = 0
-                new_record['prime_factors'] = []
-                new_record['mean_deviation'] = 0
-                new_record['antislope'] = 0
-                new_record['division_family'] = 1
-            else:
-                new_record['prime_factors'] = []
-                if new_record['is_prime']:
-                    new_record['prime_factors'].append(new_record['value'])
-                else:
-                    new_record['prime_factors'] = pp.factors(new_record['value'])
-                new_record['ideal_factor'] = self.get_ideal_factor(
-                    new_record['value'], new_record['prime_factors'])
-                new_record['mean_deviation'] = self.get_mean_deviation(
-                    new_record['prime_factors'], new_record['ideal_factor'])
-                if new_record['mean_deviation'] > 0:
-                    new_record['antislope'] = new_record['value'] / new_record['mean_deviation']
-                else:
-                    new_record['antislope'] = 0
-                new_record['division_family'] = math.prod(new_record['prime_factors'][:-1])
-            updated_collection.append(new_record)
-        self.queue.put(updated_collection)
-
-
-def decompose(logger, values_list):
+
+class Decomposer():
+    def __init__(self, engine: Optional[Union[SmallestPrimeFactorTable, SpanSieve]] = None):
+        self.engine = engine
+
+    def factor_value(self, value: int, is_prime: bool = None) -> tuple[bool, list[int]]:
+        if is_prime is None:
+            is_prime = pp.isprime(int(value))
+        if value == 1:
+            return is_prime, []
+        if is_prime:
+            return is_prime, [value]
+        return is_prime, pp.factors(value)
+
+    def factor_chunk(self, value_list, is_prime=None) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        Factor a chunk of values; a known primality mask of the values spares testing them again
+
+        Returns the values, their primality, a padded (n x width) array of prime factors and the factor counts
+        '''
+        values = np.asarray(value_list, dtype=np.int64)
+        known_primality = is_prime is not None
+        is_prime = np.array(is_prime, dtype=bool) if known_primality else np.zeros(len(values), dtype=bool)
+        counts = np.zeros(len(values), dtype=np.int64)
+        covered = np.zeros(len(values), dtype=bool)
+        covered_factors = np.zeros((0, 0), dtype=np.int64)
+        if self.engine is not None:
+            covered = self.engine.covers(values)
+            covered_factors, counts[covered] = self.engine.factor_values(values[covered])
+            if not known_primality:
+                is_prime[covered] = counts[covered] == 1
+        # values beyond the sieve engine fall back to pyprimes
+        uncovered_rows = np.flatnonzero(~covered)
+        uncovered_factors = []
+        for row in uncovered_rows.tolist():
+            is_prime[row], prime_factors = self.factor_value(int(values[row]), bool(is_prime[row]) if known_primality else None)
+            uncovered_factors.append(prime_factors)
+            counts[row] = len(prime_factors)
+
+        width = int(counts.max()) if len(counts) > 0 else 0
+        factors = np.zeros((len(values), width), dtype=np.int64)
+        factors[covered, :covered_factors.shape[1]] = covered_factors
+        for row, prime_factors in zip(uncovered_rows.tolist(), uncovered_factors):
+            factors[row, :len(prime_factors)] = prime_factors
+
+        return values, is_prime, factors, counts
+
+    def decompose_chunk(self, value_list, is_prime=None) -> list[dict]:
+        return compile_records(*self.factor_chunk(value_list, is_prime))
+
+    def decompose_chunk_shared(self, value_list, shared: SharedColumns, is_prime=None):
+        '''
+        Decompose a chunk straight into a shared memory column block
+        '''
+        values, is_prime, factors, counts = self.factor_chunk(value_list, is_prime)
+        columns = compute_metrics(values, factors, counts)
+        columns['value'] = values
+        columns['is_prime'] = is_prime
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        flat_factors = factors[np.arange(factors.shape[1]) < counts[:, None]]
+        shared.write(columns, flat_factors, offsets)
+
+
+# each pool worker holds its own decomposer, set up once by the pool initializer
+_decomposer = None
+
+
+def _init_worker(engine: SmallestPrimeFactorTable):
+    global _decomposer
+    _decomposer = Decomposer(engine)
+
+
+def _decompose_chunk(value_list, is_prime=None) -> tuple[int, int, float, list[dict]]:
+    chunk_start = time.perf_counter()
+    updated_collection = _decomposer.decompose_chunk(value_list, is_prime)
+    return os.getpid(), len(value_list), time.perf_counter() - chunk_start, updated_collection
+
+
+def _decompose_chunk_shared(value_list, buffer_name: str, factor_capacity: int, is_prime=None) -> tuple[int, int, float, str]:
+    chunk_start = time.perf_counter()
+    shared = SharedColumns(len(value_list), factor_capacity, name=buffer_name)
+    _decomposer.decompose_chunk_shared(value_list, shared, is_prime)
+    shared.close()
+    return os.getpid(), len(value_list), time.perf_counter() - chunk_start, buffer_name
+
+
+def schedule(pool, task, chunks, max_in_flight: int):
+    '''
+    Hand chunks (tuples of task arguments) to the pool on demand, keeping at most max_in_flight of them queued
+
+    Idle workers pick up the next queued chunk as soon as they are done,
+    so slow chunks do not hold the other workers back
+    '''
+    pending = deque()
+    for task_args in chunks:
+        pending.append(pool.apply_async(task, task_args))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+
+def log_worker_throughput(logger, worker_stats: dict):
+    for counter, (pid, stats) in enumerate(sorted(worker_stats.items())):
+        values_count, chunks_count, busy_time = stats
+        throughput = values_count / busy_time if busy_time > 0 else 0
+        logger.debug(f'decomposer {counter} [pid {pid}]: {values_count} values in {chunks_count} chunks; {busy_time:.2f}s busy; {throughput:.0f} values/s')
+
+
+def get_range_engine(logger, range_min: int, range_max: int, spf_table_limit: int):
+    '''
+    Pick the sieve engine for the values of [range_min..range_max]
+
+    A smallest prime factor table covers all of [0..range_max], so it is only built while range_max is
+    within spf_table_limit and the range fills at least half of the table; otherwise every chunk is
+    factored by sieving its own span with the base primes up to sqrt(range_max)
+    '''
+    step_start = datetime.utcnow()
+    span = range_max - max(range_min, 2) + 1
+    if range_max <= spf_table_limit and 2 * span >= range_max:
+        logger.debug(f'Building smallest prime factor table up to {range_max}')
+        engine = SmallestPrimeFactorTable(range_max)
+    else:
+        engine = SpanSieve(range_max)
+        logger.debug(f'Sieving chunk spans with {len(engine.base_primes)} base primes up to {math.isqrt(range_max)}')
+    logger.debug(f'...done in {datetime.utcnow()-step_start}')
+    return engine
+
+
+def decompose_chunks(logger, value_chunks, value_range: tuple = None, worker_count: int = 0, chunk_size: int = 10000, batch_size: int = 100000, transport: str = 'pickle',
+                     worker_stats: dict = None, spf_table_limit: int = 10000000):
+    '''
+    Decompose a stream of (values, is_prime) chunks through one pool of workers,
+    yielding dataframes of at most batch_size records as the workers finish them
+
+    The chunks are only pulled as the workers need more values, so the whole value list is never held at once
+    is_prime may be None where the primality of a chunk is not known
+    With a value_range of (range_min, range_max), the workers factor the values with a sieve engine for it
+    worker_stats, when given, collects the (values, chunks, busy time) of every worker
+
+    With the 'shared_memory' transport every chunk is yielded as its own dataframe,
+    backed by the shared block the worker wrote into; the frame stays valid as long as it is referenced,
+    as the block is only released once the last frame or view built on it is gone
+    '''
     logger.info('Decomposing')
     step_start = datetime.utcnow()
-    decomposers = []
-    composites_queue = Queue()
-    cpu_count = multiprocessing.cpu_count()
-    process_count = cpu_count
-
-    # TEST
-    # process_count = 1
-    logger.debug(f'{process_count} decomposers employed')
-    chunk_size = len(values_list) / max(1, (process_count - 1))
-    for counter in range(process_count):
-        start_index = int(counter * chunk_size)
-        end_index = int(min((counter + 1) * chunk_size, len(values_list)))
-        chunk = values_list[start_index: end_index]
-        decomposers.append(Decomposer(queue=composites_queue, value_list=chunk))
-
-    for decomposer in decomposers:
-        decomposer.start()
+    chunk_size = max(1, min(chunk_size, batch_size))
+    chunks = ((values[index: index + chunk_size], None if is_prime is None else is_prime[index: index + chunk_size])
+              for values, is_prime in value_chunks
+              for index in range(0, len(values), chunk_size))
+    first_chunk = next(chunks, None)
+    if first_chunk is None:
+        logger.debug('No values to decompose')
+        return
+    chunks = chain([first_chunk], chunks)
 
-    composites_collection = []
-    decomposer_process_count = process_count
-    while decomposer_process_count > 0:
-        result = composites_queue.get()
-        composites_collection.extend(result)
-        decomposer_process_count -= 1
+    engine = None
+    if value_range is not None:
+        engine = get_range_engine(logger, *value_range, spf_table_limit)
+
+    process_count = worker_count if worker_count > 0 else multiprocessing.cpu_count()
+    logger.debug(f'{process_count} decomposers employed; {chunk_size} values per chunk; {batch_size} records per batch')
+    logger.debug(f'{transport} transport')
+
+    # a spf table goes to the workers as a shared block, not as one pickled copy per worker
+    shared_table = isinstance(engine, SmallestPrimeFactorTable)
+    if transport == 'shared_memory' or shared_table:
+        share_resource_tracker()
+    if shared_table:
+        engine.share()
+    worker_stats = {} if worker_stats is None else worker_stats
+    try:
+        with multiprocessing.Pool(processes=process_count, initializer=_init_worker, initargs=(engine,)) as pool:
+            if transport == 'shared_memory':
+                batches = _collect_shared(pool, chunks, process_count * 4, worker_stats)
+            else:
+                batches = _collect_pickled(pool, chunks, process_count * 4, batch_size, worker_stats)
+            yield from batches
+    finally:
+        if shared_table:
+            engine.release()
+    log_worker_throughput(logger, worker_stats)
     step_end = datetime.utcnow()
     logger.debug(f'...done in {step_end-step_start}')
 
-    collection_df = pd.DataFrame.from_dict(composites_collection)
+
+def _add_worker_stats(worker_stats: dict, pid: int, values_count: int, busy_time: float):
+    stats = worker_stats.get(pid, (0, 0, 0.0))
+    worker_stats[pid] = (stats[0] + values_count, stats[1] + 1, stats[2] + busy_time)
+
+
+def _collect_pickled(pool, chunks, max_in_flight: int, batch_size: int, worker_stats: dict):
+    composites_collection = []
+    for pid, values_count, busy_time, result in schedule(pool, _decompose_chunk, chunks, max_in_flight):
+        _add_worker_stats(worker_stats, pid, values_count, busy_time)
+        if len(composites_collection) + len(result) > batch_size:
+            yield pd.DataFrame.from_dict(composites_collection)
+            composites_collection = []
+        composites_collection.extend(result)
+    if len(composites_collection) > 0:
+        yield pd.DataFrame.from_dict(composites_collection)
+
+
+def _collect_shared(pool, chunks, max_in_flight: int, worker_stats: dict):
+    buffers = {}
+
+    def allocate():
+        for chunk, chunk_is_prime in chunks:
+            factor_capacity = get_factor_capacity(chunk)
+            shared = SharedColumns(len(chunk), factor_capacity)
+            buffers[shared.name] = shared
+            yield chunk, shared.name, factor_capacity, chunk_is_prime
+
+    try:
+        for pid, values_count, busy_time, buffer_name in schedule(pool, _decompose_chunk_shared, allocate(), max_in_flight):
+            _add_worker_stats(worker_stats, pid, values_count, busy_time)
+            shared = buffers.pop(buffer_name)
+            yield shared.to_frame()
+            # the name is unlinked now; the memory is kept until the last frame built on it is collected
+            release_blocks([shared])
+    finally:
+        release_blocks(buffers.values())
+
+
+def decompose_window(window: SieveWindow) -> pd.DataFrame:
+    '''
+    Compile the records of a segmented sieve window into a dataframe
+    '''
+    factors, counts = pad_factors(window.factors, window.offsets)
+    collection_df = pd.DataFrame(compile_columns(window.values, window.is_prime, factors, counts))
     return collection_df
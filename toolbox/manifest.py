@@ -0,0 +1,71 @@
+import json
+import os
+import threading
+
+
+class RunManifest():
+    '''
+    Record of the value windows a generate run has finished, so a restarted run can skip them
+
+    A manifest belongs to one set of run settings; a run with other settings starts over with an empty one
+    Finished windows are appended to a journal next to the manifest, one line each; opening the manifest
+    folds the journal into it, so every update writes one line and the manifest is only rewritten once per run
+    The manifest is replaced as a whole, so a killed run leaves either the old or the new one
+    '''
+
+    def __init__(self, filepath: str, settings: dict, resume: bool = True) -> None:
+        self.filepath = filepath
+        self.journal_filepath = filepath + '.journal'
+        self.settings = settings
+        self.done = {}
+        # windows are marked done by the writer thread as well as by the run itself
+        self.lock = threading.Lock()
+        manifest = None
+        if resume and os.path.exists(filepath):
+            with open(filepath) as manifest_file:
+                manifest = json.load(manifest_file)
+        if manifest is not None and manifest['settings'] == settings:
+            self.done = manifest['done']
+            self.done.update(self.read_journal())
+            # replaying the journal again is harmless, so it goes once the manifest holds it
+            self.write()
+            self.remove_journal()
+        else:
+            # the journal of other settings must not outlive them
+            self.remove_journal()
+            self.write()
+
+    def __len__(self) -> int:
+        return len(self.done)
+
+    def is_done(self, window: str) -> bool:
+        return window in self.done
+
+    def mark_done(self, window: str, first_value: int, last_value: int):
+        with self.lock:
+            self.done[window] = [first_value, last_value]
+            with open(self.journal_filepath, 'a') as journal_file:
+                journal_file.write(json.dumps([window, first_value, last_value]) + '\n')
+
+    def read_journal(self) -> dict:
+        done = {}
+        if not os.path.exists(self.journal_filepath):
+            return done
+        with open(self.journal_filepath) as journal_file:
+            for line in journal_file:
+                try:
+                    window, first_value, last_value = json.loads(line)
+                except ValueError:
+                    # the last line of a killed run may be cut short
+                    break
+                done[window] = [first_value, last_value]
+        return done
+
+    def remove_journal(self):
+        if os.path.exists(self.journal_filepath):
+            os.remove(self.journal_filepath)
+
+    def write(self):
+        with open(self.filepath + '.tmp', 'w') as manifest_file:
+            json.dump({'settings': self.settings, 'done': self.done}, manifest_file, indent=4)
+        os.replace(self.filepath + '.tmp', self.filepath)
@@ -0,0 +1,136 @@
+import math
+
+import numpy as np
+
+_pow = np.frompyfunc(math.pow, 2, 1)
+
+
+def get_ideal_factor(value: int, prime_factors: list[int]) -> float:
+    return math.pow(value, 1/len(prime_factors))
+
+
+def get_mean_deviation(prime_factors: list[int], ideal_factor: float) -> float:
+    if all(x == prime_factors[0] for x in prime_factors):
+        return 0.0
+    deviations_sum = 0
+    for prime_factor in prime_factors:
+        deviations_sum += abs(prime_factor - ideal_factor)
+    mean_deviation = deviations_sum / len(prime_factors)
+
+    return mean_deviation
+
+
+def compile_record(value: int, is_prime: bool, prime_factors: list[int]) -> dict:
+    '''
+    Build a composite record out of a value and its (sorted) prime factors
+    '''
+    new_record = {}
+    new_record['value'] = value
+    new_record['is_prime'] = is_prime
+    if value == 1:
+        new_record['ideal_factor'] = 0
+        new_record['prime_factors'] = []
+        new_record['mean_deviation'] = 0
+        new_record['antislope'] = 0
+        new_record['division_family'] = 1
+        return new_record
+
+    new_record['prime_factors'] = prime_factors
+    new_record['ideal_factor'] = get_ideal_factor(value, prime_factors)
+    new_record['mean_deviation'] = get_mean_deviation(prime_factors, new_record['ideal_factor'])
+    if new_record['mean_deviation'] > 0:
+        new_record['antislope'] = value / new_record['mean_deviation']
+    else:
+        new_record['antislope'] = 0
+    new_record['division_family'] = math.prod(prime_factors[:-1])
+
+    return new_record
+
+
+def pad_factors(factors: np.ndarray, offsets: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Convert flat (CSR) factorizations into a padded 2-D array
+
+    Returns the padded array, one row per value, and the factor count of each row
+    Padding cells hold 0 and are ignored by the kernel
+    '''
+    counts = np.diff(offsets)
+    width = int(counts.max()) if len(counts) > 0 else 0
+    padded = np.zeros((len(counts), width), dtype=np.int64)
+    rows = np.repeat(np.arange(len(counts)), counts)
+    columns = np.arange(len(factors)) - np.repeat(offsets[:-1], counts)
+    padded[rows, columns] = factors
+
+    return padded, counts
+
+
+def compute_metrics(values: np.ndarray, factors: np.ndarray, counts: np.ndarray) -> dict:
+    '''
+    Batch version of compile_record for a whole chunk of factorizations
+
+    values: int64 array of n values
+    factors: padded (n x width) array of sorted prime factors
+    counts: number of prime factors in each row; 0 for value 1
+
+    Columns are accumulated one at a time in factor order, so the float results
+    match the per-record functions bit for bit
+    '''
+    values = np.asarray(values, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+    has_factors = counts > 0
+    safe_counts = np.where(has_factors, counts, 1)
+
+    # math.pow is kept on purpose: numpy's SIMD pow can land one ulp away from it
+    ideal_factor = values.astype(np.float64)
+    ideal_factor[~has_factors] = 0
+    rooted = counts > 1
+    ideal_factor[rooted] = _pow(ideal_factor[rooted], 1 / counts[rooted]).astype(np.float64)
+
+    deviations_sum = np.zeros(len(values), dtype=np.float64)
+    all_equal = np.ones(len(values), dtype=bool)
+    division_family = np.ones(len(values), dtype=np.int64)
+    for column in range(factors.shape[1]):
+        rows = np.flatnonzero(counts > column)
+        factor_column = factors[rows, column]
+        deviations_sum[rows] += np.abs(factor_column - ideal_factor[rows])
+        all_equal[rows] &= factor_column == factors[rows, 0]
+        # the largest factor is left out of the division family
+        family_rows = counts[rows] > column + 1
+        division_family[rows[family_rows]] *= factor_column[family_rows]
+    mean_deviation = np.where(all_equal, 0.0, deviations_sum / safe_counts)
+
+    positive = mean_deviation > 0
+    antislope = np.zeros(len(values), dtype=np.float64)
+    antislope[positive] = values[positive] / mean_deviation[positive]
+
+    metrics = {}
+    metrics['ideal_factor'] = ideal_factor
+    metrics['mean_deviation'] = mean_deviation
+    metrics['antislope'] = antislope
+    metrics['division_family'] = division_family
+
+    return metrics
+
+
+def compile_columns(values: np.ndarray, is_prime: np.ndarray, factors: np.ndarray, counts: np.ndarray) -> dict:
+    '''
+    Build the composite columns for a whole chunk of padded factorizations
+    '''
+    metrics = compute_metrics(values, factors, counts)
+    columns = {}
+    columns['value'] = np.asarray(values, dtype=np.int64)
+    columns['is_prime'] = np.asarray(is_prime, dtype=bool)
+    columns['prime_factors'] = [row[:count] for row, count in zip(factors.tolist(), counts.tolist())]
+    columns.update(metrics)
+
+    return columns
+
+
+def compile_records(values: np.ndarray, is_prime: np.ndarray, factors: np.ndarray, counts: np.ndarray) -> list[dict]:
+    '''
+    Build composite records for a whole chunk of padded factorizations
+    '''
+    columns = compile_columns(values, is_prime, factors, counts)
+    keys = list(columns.keys())
+    rows = zip(*[column.tolist() if isinstance(column, np.ndarray) else column for column in columns.values()])
+    return [dict(zip(keys, row)) for row in rows]
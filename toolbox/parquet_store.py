@@ -0,0 +1,168 @@
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from progress.bar import Bar
+
+from toolbox.factor_codec import encode_prime_factors_column
+from toolbox.value_spans import get_value_spans
+
+SCHEMA = pa.schema([
+    ('value', pa.int64()),
+    ('is_prime', pa.bool_()),
+    ('ideal_factor', pa.float64()),
+    ('prime_factors', pa.binary()),
+    ('mean_deviation', pa.float64()),
+    ('antislope', pa.float64()),
+    ('division_family', pa.int64()),
+])
+
+
+class ParquetDataManager():
+    '''
+    Keeps the composites as Parquet files, partitioned by value
+
+    Partition n holds the values in [n * partition_size .. (n + 1) * partition_size - 1], one folder
+    per partition and one file per save; reads only open the partitions the requested values fall into,
+    read only the requested columns and push the value predicates down to the row group statistics
+    '''
+
+    METADATA_FILENAME = 'store.json'
+
+    def __init__(self, folder: str, partition_size: int = 1000000, logger=None) -> None:
+        self.folder = folder
+        self.partition_size = partition_size
+        self.logger = logger
+        metadata_filepath = os.path.join(folder, self.METADATA_FILENAME)
+        if os.path.exists(metadata_filepath):
+            # the layout of an existing store wins over the configured one
+            with open(metadata_filepath) as metadata_file:
+                self.partition_size = json.load(metadata_file)['partition_size']
+
+
+    def get_partition_folder(self, partition: int) -> str:
+        return os.path.join(self.folder, f'partition={partition}')
+
+
+    def get_partition_files(self, partitions) -> list[str]:
+        filepaths = []
+        for partition in partitions:
+            partition_folder = self.get_partition_folder(int(partition))
+            if os.path.exists(partition_folder):
+                # files still being written carry a .tmp suffix
+                filepaths.extend(os.path.join(partition_folder, filename) for filename in sorted(os.listdir(partition_folder))
+                                 if filename.endswith('.parquet'))
+        return filepaths
+
+
+    def get_all_files(self) -> list[str]:
+        if not os.path.exists(self.folder):
+            return []
+        partitions = [int(name.split('=')[1]) for name in os.listdir(self.folder) if name.startswith('partition=')]
+        return self.get_partition_files(sorted(partitions))
+
+
+    def save_data(self, data: pd.DataFrame):
+        '''Saves the data as one new file in every partition it touches'''
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+            with open(os.path.join(self.folder, self.METADATA_FILENAME), 'w') as metadata_file:
+                json.dump({'partition_size': self.partition_size}, metadata_file, indent=4)
+        start = time.perf_counter()
+        data = data.sort_values('value')
+        values = data['value'].to_numpy(dtype=np.int64)
+        table = pa.table({
+            'value': values,
+            'is_prime': data['is_prime'].to_numpy(dtype=bool),
+            'ideal_factor': data['ideal_factor'].to_numpy(dtype=np.float64),
+            'prime_factors': encode_prime_factors_column(data['prime_factors'].tolist()),
+            'mean_deviation': data['mean_deviation'].to_numpy(dtype=np.float64),
+            'antislope': data['antislope'].to_numpy(dtype=np.float64),
+            'division_family': data['division_family'].to_numpy(dtype=np.int64),
+        }, schema=SCHEMA)
+
+        partitions = values // self.partition_size
+        partition_starts = np.flatnonzero(np.diff(partitions, prepend=-1))
+        partition_ends = np.append(partition_starts[1:], len(partitions))
+        with Bar('Adding records to store', max=len(partition_starts)) as bar:
+            for partition_start, partition_end in zip(partition_starts.tolist(), partition_ends.tolist()):
+                partition_folder = self.get_partition_folder(int(partitions[partition_start]))
+                os.makedirs(partition_folder, exist_ok=True)
+                part_count = sum(filename.endswith('.parquet') for filename in os.listdir(partition_folder))
+                filepath = os.path.join(partition_folder, f'part-{part_count:05d}.parquet')
+                # readers only see whole files
+                pq.write_table(table.slice(partition_start, partition_end - partition_start), filepath + '.tmp')
+                os.replace(filepath + '.tmp', filepath)
+                bar.next()
+
+        elapsed = time.perf_counter() - start
+        if self.logger is not None and elapsed > 0:
+            self.logger.debug(f'{len(data)} rows written in {elapsed:.2f}s ({len(data) / elapsed:.0f} rows/s)')
+
+
+    def read(self, filepaths: list[str], columns: list = None, predicate=None) -> pd.DataFrame:
+        '''Reads the given columns of the rows matching a predicate from a set of files'''
+        columns = columns or SCHEMA.names
+        if len(filepaths) == 0:
+            return SCHEMA.empty_table().select(columns).to_pandas()
+        dataset = ds.dataset(filepaths, schema=SCHEMA, format='parquet')
+        return dataset.to_table(columns=columns, filter=predicate).to_pandas()
+
+
+    def load_data(self, value_list, exclude_primes: bool = False, columns: list = None, max_spans: int = 10) -> pd.DataFrame:
+        '''
+        Loads raw data, corresponding to a list of int values, optionally only some columns
+
+        Lists that fall into a few dense spans are read with range predicates; scattered lists with a set lookup
+        '''
+        columns = list(dict.fromkeys(['value'] + columns)) if columns else None
+        values, span_starts, span_ends = get_value_spans(value_list)
+        if len(values) == 0:
+            return self.read([], columns)
+        if len(span_starts) <= max_spans:
+            predicate = None
+            for span_start, span_end in zip(span_starts.tolist(), span_ends.tolist()):
+                span_predicate = (ds.field('value') >= span_start) & (ds.field('value') <= span_end)
+                predicate = span_predicate if predicate is None else predicate | span_predicate
+        else:
+            predicate = ds.field('value').isin(pa.array(values))
+        if exclude_primes:
+            predicate = predicate & ~ds.field('is_prime')
+        raw_df = self.read(self.get_partition_files(np.unique(values // self.partition_size)), columns, predicate)
+        # spans may hold values that were not requested
+        raw_df = raw_df[np.isin(raw_df['value'].to_numpy(), values)].sort_values('value').reset_index(drop=True)
+
+        return raw_df
+
+
+    def load_value_data(self, value_list) -> pd.DataFrame:
+        '''Loads value data, corresponding to a list of int values'''
+        return self.load_data(value_list, columns=['value'])
+
+
+    def load_value_range(self, lower: int, upper: int, columns: list = None, exclude_primes: bool = False) -> pd.DataFrame:
+        '''Loads raw data for all values in [lower..upper], optionally only some columns'''
+        predicate = (ds.field('value') >= lower) & (ds.field('value') <= upper)
+        if exclude_primes:
+            predicate = predicate & ~ds.field('is_prime')
+        partitions = range(lower // self.partition_size, upper // self.partition_size + 1)
+        return self.read(self.get_partition_files(partitions), columns, predicate).sort_values('value').reset_index(drop=True)
+
+
+    def get_column_bounds(self, column: str = 'value', exclude_primes: bool = False) -> tuple:
+        '''Gets the smallest and largest stored values of a column and the number of stored rows'''
+        predicate = ~ds.field('is_prime') if exclude_primes else None
+        filepaths = self.get_all_files()
+        if len(filepaths) == 0:
+            return None, None, 0
+        column_data = ds.dataset(filepaths, schema=SCHEMA, format='parquet').to_table(columns=[column], filter=predicate)[column]
+        if len(column_data) == 0:
+            return None, None, 0
+        bounds = pc.min_max(column_data)
+        return bounds['min'].as_py(), bounds['max'].as_py(), len(column_data)
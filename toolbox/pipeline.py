@@ -0,0 +1,135 @@
+import queue
+import threading
+import time
+
+
+class StageClock():
+    '''Busy time of one pipeline stage'''
+
+    def __init__(self, name: str, capacity: int = 1) -> None:
+        self.name = name
+        self.capacity = capacity
+        self.busy = 0.0
+
+    def add(self, start: float):
+        self.busy += time.perf_counter() - start
+
+
+def timed(iterable, clock: StageClock):
+    '''
+    Iterate, adding the time spent producing every item to the clock
+    '''
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            clock.add(start)
+            return
+        clock.add(start)
+        yield item
+
+
+class BatchWriter():
+    '''
+    Saves batches on a dedicated thread, fed through a bounded queue
+
+    The producer blocks once queue_size batches are waiting, so a slow data store holds back
+    the decomposers instead of letting finished batches pile up in memory
+    With queue_size 0 every batch is saved straight away on the calling thread
+    '''
+
+    def __init__(self, data_manager, queue_size: int, logger=None) -> None:
+        self.data_manager = data_manager
+        self.queue_size = queue_size
+        self.logger = logger
+        self.saved_count = 0
+        self.write_clock = StageClock('write')
+        # time the producer spent blocked on a full queue
+        self.blocked_clock = StageClock('blocked')
+        self.error = None
+        if queue_size > 0:
+            self.queue = queue.Queue(maxsize=queue_size)
+            self.thread = threading.Thread(target=self.drain, name='batch-writer', daemon=True)
+            self.thread.start()
+
+    def put(self, batch, on_saved=None):
+        '''
+        Queue a batch for saving; on_saved is called with the running saved count once it is saved
+        '''
+        if self.queue_size == 0:
+            self.write(batch, on_saved)
+            return
+        start = time.perf_counter()
+        self.hand_over((batch, on_saved))
+        self.blocked_clock.add(start)
+
+    def hand_over(self, item):
+        while True:
+            if self.error is not None:
+                raise RuntimeError('The batch writer stopped') from self.error
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def write(self, batch, on_saved):
+        start = time.perf_counter()
+        self.data_manager.save_data(batch)
+        self.saved_count += len(batch)
+        if on_saved is not None:
+            on_saved(self.saved_count)
+        self.write_clock.add(start)
+        if self.logger is not None:
+            self.logger.debug(f'{len(batch)} records saved in {time.perf_counter() - start:.2f}s [{self.saved_count} in total]')
+
+    def drain(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self.write(*item)
+            except Exception as e:
+                self.error = e
+                return
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        '''
+        Wait until every queued batch is saved, keeping the writer open
+        '''
+        if self.queue_size > 0:
+            # a failed writer leaves its batches unfinished, so the queue is not simply joined
+            with self.queue.all_tasks_done:
+                while self.queue.unfinished_tasks > 0 and self.error is None:
+                    self.queue.all_tasks_done.wait(timeout=1)
+        if self.error is not None:
+            raise RuntimeError('The batch writer stopped') from self.error
+
+    def close(self):
+        '''
+        Wait until every queued batch is saved
+        '''
+        if self.queue_size > 0:
+            if self.error is None:
+                self.hand_over(None)
+            self.thread.join()
+        if self.error is not None:
+            raise RuntimeError('The batch writer stopped') from self.error
+
+
+def log_utilization(logger, wall_time: float, clocks: list[StageClock], blocked_time: float):
+    '''
+    Log how busy every stage was over the run; a stage of n workers has n times the wall time available
+    '''
+    logger.info(f'Pipeline: {wall_time:.2f}s')
+    for clock in clocks:
+        available = wall_time * clock.capacity
+        utilization = clock.busy / available * 100 if available > 0 else 0
+        workers = f' ({clock.capacity} workers)' if clock.capacity > 1 else ''
+        logger.info(f'  {clock.name}{workers}: {clock.busy:.2f}s busy; {utilization:.0f}% utilized')
+    logger.info(f'  {blocked_time:.2f}s blocked on a full write queue')
@@ -0,0 +1,37 @@
+import numpy as np
+
+
+def get_extent(values: np.ndarray) -> tuple[float, float]:
+    '''
+    Get the (min, max) of a coordinate, widened when all values are equal
+    '''
+    if len(values) == 0:
+        return 0.0, 1.0
+    lower = float(values.min())
+    upper = float(values.max())
+    if lower == upper:
+        lower -= 0.5
+        upper += 0.5
+    return lower, upper
+
+
+def rasterize(x: np.ndarray, y: np.ndarray, width: int, height: int, bucket_ids: np.ndarray = None,
+              x_extent: tuple = None, y_extent: tuple = None) -> tuple[np.ndarray, tuple, tuple]:
+    '''
+    Aggregate points into a fixed (height x width) pixel grid
+
+    Without bucket ids each pixel holds log(1 + point count); with them, the mean bucket id
+    of its points; empty pixels are NaN
+    Returns the grid (row 0 at the bottom) and the x and y extents it covers
+    '''
+    x_extent = x_extent or get_extent(x)
+    y_extent = y_extent or get_extent(y)
+    counts, x_edges, y_edges = np.histogram2d(x, y, bins=[width, height], range=[x_extent, y_extent])
+    if bucket_ids is None:
+        grid = np.log1p(counts)
+    else:
+        bucket_sums, x_edges, y_edges = np.histogram2d(x, y, bins=[width, height], range=[x_extent, y_extent], weights=bucket_ids)
+        grid = np.divide(bucket_sums, counts, out=np.zeros_like(bucket_sums), where=counts > 0)
+    grid[counts == 0] = np.nan
+
+    return grid.T, (x_edges[0], x_edges[-1]), (y_edges[0], y_edges[-1])
@@ -0,0 +1,254 @@
+import math
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from toolbox.metrics import pad_factors
+
+
+def build_spf_table(limit: int) -> np.ndarray:
+    '''
+    Build a smallest-prime-factor table for all numbers in [0..limit]
+
+    spf[n] holds the smallest prime dividing n; primes map onto themselves
+    0 and 1 are left at 0
+    '''
+    dtype = np.int32 if limit < np.iinfo(np.int32).max else np.int64
+    spf = np.zeros(limit + 1, dtype=dtype)
+    for prime in range(2, math.isqrt(limit) + 1):
+        if spf[prime] != 0:
+            continue
+        multiples = spf[prime * prime::prime]
+        multiples[multiples == 0] = prime
+    unmarked = np.flatnonzero(spf == 0)
+    unmarked = unmarked[unmarked >= 2]
+    spf[unmarked] = unmarked
+
+    return spf
+
+
+class SmallestPrimeFactorTable():
+    '''
+    Factorization engine backed by a smallest-prime-factor sieve
+
+    Once shared, the table lives in a shared memory block and the engine pickles down to the
+    name of that block, so spawned pool workers attach to it instead of each receiving a copy
+    '''
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.spf = build_spf_table(limit)
+        self.shm = None
+
+    def share(self):
+        '''
+        Move the table into a shared memory block
+        '''
+        shm = shared_memory.SharedMemory(create=True, size=max(self.spf.nbytes, 1))
+        spf = np.ndarray(self.spf.shape, dtype=self.spf.dtype, buffer=shm.buf)
+        spf[:] = self.spf
+        self.spf = spf
+        self.shm = shm
+
+    def release(self):
+        '''
+        Free the shared memory block; the engine is unusable afterwards
+        '''
+        if self.shm is None:
+            return
+        self.spf = None
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+    def __getstate__(self) -> dict:
+        if self.shm is None:
+            return self.__dict__
+        return {'limit': self.limit, 'name': self.shm.name, 'dtype': self.spf.dtype.str}
+
+    def __setstate__(self, state: dict):
+        if 'name' not in state:
+            self.__dict__.update(state)
+            return
+        self.limit = state['limit']
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self.spf = np.ndarray((self.limit + 1,), dtype=np.dtype(state['dtype']), buffer=self.shm.buf)
+
+    def covers(self, values: np.ndarray) -> np.ndarray:
+        return (values >= 2) & (values <= self.limit)
+
+    def factor_values(self, values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Factor a whole array of covered values at once
+
+        Returns a padded (n x width) array of sorted prime factors and the factor count of each row
+        '''
+        residuals = np.asarray(values, dtype=np.int64).copy()
+        factor_columns = []
+        while True:
+            remaining = residuals > 1
+            if not remaining.any():
+                break
+            primes = np.where(remaining, self.spf[residuals], 0).astype(np.int64)
+            factor_columns.append(primes)
+            residuals[remaining] //= primes[remaining]
+        if len(factor_columns) == 0:
+            return np.zeros((len(residuals), 0), dtype=np.int64), np.zeros(len(residuals), dtype=np.int64)
+        factors = np.stack(factor_columns, axis=1)
+        counts = np.count_nonzero(factors, axis=1)
+
+        return factors, counts
+
+
+def get_base_primes(limit: int) -> np.ndarray:
+    '''
+    Get all primes in [2..limit] as an int64 array
+    '''
+    if limit < 2:
+        return np.array([], dtype=np.int64)
+    spf = build_spf_table(limit)
+    candidates = np.arange(limit + 1, dtype=np.int64)
+    return candidates[(candidates >= 2) & (spf == candidates)]
+
+
+def sieve_primality(lower: int, upper: int) -> np.ndarray:
+    '''
+    Sieve of Eratosthenes over [lower..upper]
+
+    Returns a bool array; entry i tells whether lower + i is prime
+    '''
+    lower = max(lower, 0)
+    if upper < lower:
+        return np.zeros(0, dtype=bool)
+    is_prime = np.ones(upper - lower + 1, dtype=bool)
+    is_prime[:max(2 - lower, 0)] = False
+    for prime in get_base_primes(math.isqrt(upper)).tolist():
+        first_multiple = max(prime * prime, -(-lower // prime) * prime)
+        is_prime[first_multiple - lower::prime] = False
+
+    return is_prime
+
+
+def get_primes_between(lower: int, upper: int) -> np.ndarray:
+    '''
+    Get all primes in [lower..upper] as an int64 array
+    '''
+    return np.flatnonzero(sieve_primality(lower, upper)) + max(lower, 0)
+
+
+class SieveWindow():
+    '''Factorizations of a contiguous window of values, in flat (CSR) form'''
+
+    def __init__(self, values: np.ndarray, is_prime: np.ndarray, factors: np.ndarray, offsets: np.ndarray) -> None:
+        self.values = values
+        self.is_prime = is_prime
+        self.factors = factors
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def select(self, mask: np.ndarray) -> 'SieveWindow':
+        '''
+        Get a new window holding only the rows selected by a boolean mask
+        '''
+        counts = np.diff(self.offsets)
+        factor_mask = np.repeat(mask, counts)
+        offsets = np.zeros(np.count_nonzero(mask) + 1, dtype=np.int64)
+        np.cumsum(counts[mask], out=offsets[1:])
+        return SieveWindow(self.values[mask], self.is_prime[mask], self.factors[factor_mask], offsets)
+
+
+def factor_span(base_primes: np.ndarray, lower: int, upper: int) -> SieveWindow:
+    '''
+    Factor every value in [lower..upper] by sieving the span with the base primes
+
+    The base primes have to reach up to sqrt(upper)
+    '''
+    values = np.arange(lower, upper + 1, dtype=np.int64)
+    residuals = values.copy()
+    factor_rows = []
+    factor_primes = []
+    for prime in base_primes.tolist():
+        first_multiple = -(-lower // prime) * prime
+        if first_multiple > upper:
+            continue
+        rows = np.arange(first_multiple - lower, len(values), prime)
+        # strip each power of the prime in turn; primes come in ascending order
+        while len(rows) > 0:
+            residuals[rows] //= prime
+            factor_rows.append(rows)
+            factor_primes.append(np.full(len(rows), prime, dtype=np.int64))
+            rows = rows[residuals[rows] % prime == 0]
+    # whatever is left above 1 is a single prime larger than the base primes
+    remainder_rows = np.flatnonzero(residuals > 1)
+    factor_rows.append(remainder_rows)
+    factor_primes.append(residuals[remainder_rows])
+
+    factor_rows = np.concatenate(factor_rows)
+    factor_primes = np.concatenate(factor_primes)
+    order = np.argsort(factor_rows, kind='stable')
+    factors = factor_primes[order]
+    counts = np.bincount(factor_rows, minlength=len(values))
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    is_prime = counts == 1
+
+    return SieveWindow(values, is_prime, factors, offsets)
+
+
+class SegmentedSieve():
+    '''
+    Factorization engine walking [range_min..range_max] in fixed-size windows
+
+    Only the base primes up to sqrt(range_max) are kept in memory, so the
+    peak memory is bounded by the window size, not by the range
+    '''
+
+    def __init__(self, range_min: int, range_max: int, segment_size: int) -> None:
+        self.range_min = max(range_min, 1)
+        self.range_max = range_max
+        self.segment_size = segment_size
+        self.base_primes = get_base_primes(math.isqrt(range_max))
+
+    def windows(self):
+        '''
+        Iterate the [lower, upper] bounds of all windows
+        '''
+        for lower in range(self.range_min, self.range_max + 1, self.segment_size):
+            yield lower, min(lower + self.segment_size - 1, self.range_max)
+
+    def factor_window(self, lower: int, upper: int) -> SieveWindow:
+        return factor_span(self.base_primes, lower, upper)
+
+
+class SpanSieve():
+    '''
+    Factorization engine sieving the span of every chunk of values it is given
+
+    Only the base primes up to sqrt(limit) are kept, so it suits ranges too large, or too sparse,
+    for a smallest-prime-factor table over [0..limit]
+    '''
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.base_primes = get_base_primes(math.isqrt(limit))
+
+    def covers(self, values: np.ndarray) -> np.ndarray:
+        return (values >= 2) & (values <= self.limit)
+
+    def factor_values(self, values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Factor a whole array of covered values at once
+
+        Returns a padded (n x width) array of sorted prime factors and the factor count of each row
+        '''
+        values = np.asarray(values, dtype=np.int64)
+        if len(values) == 0:
+            return np.zeros((0, 0), dtype=np.int64), np.zeros(0, dtype=np.int64)
+        lower = int(values.min())
+        window = factor_span(self.base_primes, lower, int(values.max()))
+        factors, counts = pad_factors(window.factors, window.offsets)
+        rows = values - lower
+
+        return factors[rows], counts[rows]
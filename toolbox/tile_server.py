@@ -0,0 +1,83 @@
+import math
+
+import numpy as np
+from bokeh.events import RangesUpdate
+from bokeh.models import ColumnDataSource, HoverTool, LinearColorMapper, Range1d
+from bokeh.plotting import figure
+from bokeh.server.server import Server
+
+from toolbox.factor_codec import decode_prime_factor_lists
+from toolbox.tiles import TileStore
+
+
+def get_detail_data(data_manager, tile_store: TileStore, x_start: float, x_end: float) -> dict:
+    '''
+    Load the full records of the values in view
+    '''
+    metric = tile_store.metadata['metric']
+    detail_df = data_manager.load_value_range(math.ceil(x_start), math.floor(x_end), exclude_primes=tile_store.metadata['exclude_primes'])
+    detail_data = {column: detail_df[column].to_numpy() for column in ['value', 'ideal_factor', 'mean_deviation', 'antislope', 'division_family']}
+    detail_data['y'] = detail_df[metric].to_numpy()
+    detail_data['prime_factors'] = [str(factors) for factors in decode_prime_factor_lists(detail_df['prime_factors'])]
+    return detail_data
+
+
+def get_image_data(tile_store: TileStore, x_start: float, x_end: float, pixel_width: int) -> dict:
+    grid, x_extent, y_extent = tile_store.get_view(x_start, x_end, pixel_width)
+    image_data = {}
+    image_data['image'] = [grid.astype(np.float32)]
+    image_data['x'] = [x_extent[0]]
+    image_data['y'] = [y_extent[0]]
+    image_data['dw'] = [x_extent[1] - x_extent[0]]
+    image_data['dh'] = [y_extent[1] - y_extent[0]]
+    return image_data
+
+
+def serve_tiles(logger, data_manager, tile_store: TileStore, graph_params: dict, colors: list, detail_points: int, port: int):
+    '''
+    Serve the tiled plot through a local bokeh server
+
+    Every pan or zoom loads only the tiles in view, at the resolution the plot width needs;
+    once few enough records are in view, they are loaded and drawn as points instead
+    '''
+    width = graph_params['width']
+    empty_image = {'image': [], 'x': [], 'y': [], 'dw': [], 'dh': []}
+    empty_detail = {column: [] for column in ['value', 'y', 'prime_factors', 'ideal_factor', 'mean_deviation', 'antislope', 'division_family']}
+
+    def make_document(doc):
+        x_extent, y_extent = tile_store.get_extents()
+        image_source = ColumnDataSource(get_image_data(tile_store, x_extent[0], x_extent[1], width))
+        detail_source = ColumnDataSource(dict(empty_detail))
+        color_mapper = LinearColorMapper(palette=colors, low=0, high=math.log1p(tile_store.metadata['row_count']), nan_color='rgba(0, 0, 0, 0)')
+
+        plot = figure(title=graph_params['title'], width=width, height=graph_params['height'],
+                      x_range=Range1d(*x_extent), y_range=Range1d(*y_extent),
+                      x_axis_label=graph_params['x_axis'], y_axis_label=graph_params['y_axis_label'])
+        plot.image(image='image', x='x', y='y', dw='dw', dh='dh', source=image_source, color_mapper=color_mapper)
+        detail_renderer = plot.scatter('value', 'y', source=detail_source, size=graph_params['point_size'])
+        plot.add_tools(HoverTool(renderers=[detail_renderer], tooltips=[
+            ('number', '@value'),
+            ('factors', '@prime_factors'),
+            ('mean factor value', '@ideal_factor'),
+            ('mean factor deviation', '@mean_deviation'),
+            ('antislope', '@antislope'),
+            ('division family', '@division_family')]))
+
+        def update_view(event):
+            if tile_store.estimate_rows(event.x0, event.x1) <= detail_points:
+                detail_source.data = get_detail_data(data_manager, tile_store, event.x0, event.x1)
+                image_source.data = dict(empty_image)
+                logger.debug(f'[{event.x0:.0f}..{event.x1:.0f}] {len(detail_source.data["value"])} records loaded')
+            else:
+                image_source.data = get_image_data(tile_store, event.x0, event.x1, width)
+                detail_source.data = dict(empty_detail)
+
+        plot.on_event(RangesUpdate, update_view)
+        doc.add_root(plot)
+        doc.title = graph_params['output_file_title']
+
+    server = Server({'/': make_document}, port=port)
+    server.start()
+    logger.info(f'Serving tiled plot at http://localhost:{port}/')
+    server.io_loop.add_callback(server.show, '/')
+    server.io_loop.start()
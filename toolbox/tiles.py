@@ -0,0 +1,125 @@
+import json
+import math
+import os
+import shutil
+
+import numpy as np
+
+
+class TileStore():
+    '''
+    Multi-resolution density tiles of one y metric over the composites table
+
+    Level L splits the stored value span into 2**L tiles; every tile is a
+    (y_bins x tile_size) grid of point counts, and all levels share the same
+    y extent, so tiles of any level line up
+    '''
+
+    METADATA_FILENAME = 'tiles.json'
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        self.metadata = None
+        metadata_filepath = os.path.join(folder, self.METADATA_FILENAME)
+        if os.path.exists(metadata_filepath):
+            with open(metadata_filepath) as metadata_file:
+                self.metadata = json.load(metadata_file)
+
+    def get_tile_filepath(self, level: int, index: int) -> str:
+        return os.path.join(self.folder, str(level), f'{index}.npy')
+
+    def is_current(self, settings: dict) -> bool:
+        '''
+        Check whether the store was built with the given settings from the same data
+        '''
+        if self.metadata is None:
+            return False
+        return all(self.metadata.get(key) == value for key, value in settings.items())
+
+    def build(self, data_manager, metric: str, levels: int, tile_size: int, y_bins: int,
+              exclude_primes: bool = False, window_size: int = 1000000, logger=None) -> None:
+        '''
+        Stream the composites table window by window into the finest level,
+        then derive every coarser level by merging pairs of neighbouring bins
+        '''
+        x_min, x_max, row_count = data_manager.get_column_bounds('value', exclude_primes)
+        y_min, y_max, row_count = data_manager.get_column_bounds(metric, exclude_primes)
+        if row_count == 0:
+            raise ValueError('There is no data to build tiles from')
+        if y_min == y_max:
+            y_max = y_min + 1
+        finest_width = 2 ** (levels - 1) * tile_size
+        value_span = x_max - x_min + 1
+        grid = np.zeros(finest_width * y_bins, dtype=np.int64)
+
+        for window_start in range(x_min, x_max + 1, window_size):
+            window_end = min(window_start + window_size - 1, x_max)
+            window_df = data_manager.load_value_range(window_start, window_end, ['value', metric], exclude_primes)
+            x_bins = (window_df['value'].to_numpy() - x_min) * finest_width // value_span
+            y_positions = (window_df[metric].to_numpy() - y_min) / (y_max - y_min) * y_bins
+            y_bins_of_rows = np.clip(y_positions.astype(np.int64), 0, y_bins - 1)
+            grid += np.bincount(x_bins * y_bins + y_bins_of_rows, minlength=len(grid))
+            if logger is not None:
+                logger.debug(f'[{window_start}..{window_end}] {len(window_df)} rows binned')
+
+        if os.path.exists(self.folder):
+            shutil.rmtree(self.folder)
+        grid = grid.reshape(finest_width, y_bins)
+        for level in range(levels - 1, -1, -1):
+            os.makedirs(os.path.join(self.folder, str(level)))
+            for index in range(2 ** level):
+                np.save(self.get_tile_filepath(level, index), grid[index * tile_size:(index + 1) * tile_size].T)
+            grid = grid.reshape(-1, 2, y_bins).sum(axis=1)
+
+        self.metadata = {
+            'metric': metric,
+            'exclude_primes': exclude_primes,
+            'levels': levels,
+            'tile_size': tile_size,
+            'y_bins': y_bins,
+            'row_count': row_count,
+            'x_min': x_min,
+            'x_max': x_max,
+            'y_min': y_min,
+            'y_max': y_max,
+        }
+        with open(os.path.join(self.folder, self.METADATA_FILENAME), 'w') as metadata_file:
+            json.dump(self.metadata, metadata_file, indent=4)
+
+    def get_extents(self) -> tuple[tuple, tuple]:
+        return (self.metadata['x_min'], self.metadata['x_max'] + 1), (self.metadata['y_min'], self.metadata['y_max'])
+
+    def estimate_rows(self, x_start: float, x_end: float) -> int:
+        (x_min, x_max), y_extent = self.get_extents()
+        return int(self.metadata['row_count'] * max(x_end - x_start, 0) / (x_max - x_min))
+
+    def get_view(self, x_start: float, x_end: float, pixel_width: int) -> tuple[np.ndarray, tuple, tuple]:
+        '''
+        Assemble the density grid of [x_start..x_end] from the coarsest level that still
+        offers pixel_width bins across it; only the tiles in view are read
+
+        Returns the grid (log of 1 + count, NaN where empty) and its x and y extents
+        '''
+        (x_min, x_max), y_extent = self.get_extents()
+        levels = self.metadata['levels']
+        tile_size = self.metadata['tile_size']
+        x_start = min(max(x_start, x_min), x_max)
+        x_end = min(max(x_end, x_start), x_max)
+        visible_share = max((x_end - x_start) / (x_max - x_min), 1e-12)
+
+        level = levels - 1
+        for candidate_level in range(levels):
+            if visible_share * 2 ** candidate_level * tile_size >= pixel_width:
+                level = candidate_level
+                break
+        tile_span = (x_max - x_min) / 2 ** level
+        first_tile = min(int((x_start - x_min) // tile_span), 2 ** level - 1)
+        last_tile = min(max(math.ceil((x_end - x_min) / tile_span) - 1, first_tile), 2 ** level - 1)
+
+        tiles = [np.load(self.get_tile_filepath(level, index), mmap_mode='r') for index in range(first_tile, last_tile + 1)]
+        counts = np.hstack(tiles)
+        grid = np.log1p(counts.astype(np.float64))
+        grid[counts == 0] = np.nan
+        x_extent = (x_min + first_tile * tile_span, x_min + (last_tile + 1) * tile_span)
+
+        return grid, x_extent, y_extent
@@ -0,0 +1,136 @@
+import os
+import weakref
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import pandas as pd
+
+# 8-byte columns go first so every column stays aligned
+COLUMNS = [
+    ('value', np.int64),
+    ('ideal_factor', np.float64),
+    ('mean_deviation', np.float64),
+    ('antislope', np.float64),
+    ('division_family', np.int64),
+]
+
+
+def get_factor_capacity(value_list) -> int:
+    '''
+    Upper bound for the number of prime factors (with multiplicity) of all values in a chunk
+    '''
+    if len(value_list) == 0:
+        return 0
+    max_factor_count = max(int(max(value_list)).bit_length() - 1, 1)
+    return len(value_list) * max_factor_count
+
+
+# blocks whose frames outlived their run; they stay referenced here, so they are
+# never closed under a live view, and get released on a later call
+_unreleased = []
+
+
+def release_blocks(blocks) -> None:
+    '''
+    Release shared blocks, keeping the ones still in use for a later attempt
+    '''
+    blocks = list(blocks) + _unreleased
+    _unreleased[:] = [shared for shared in blocks if not shared.release()]
+
+
+def share_resource_tracker():
+    '''
+    Start the resource tracker before any workers are started
+
+    Workers then report to the same tracker as the driver, instead of starting
+    their own ones that would unlink the blocks when the workers exit
+    '''
+    if os.name == 'posix':
+        resource_tracker.ensure_running()
+
+
+class SharedColumns():
+    '''
+    Columnar composite records in a shared memory block
+
+    The driver creates the block, a worker attaches to it by name and fills it in,
+    and the driver wraps the filled columns into a dataframe without copying them
+    '''
+
+    def __init__(self, length: int, factor_capacity: int, name: str = None) -> None:
+        self.length = length
+        self.factor_capacity = factor_capacity
+        self.layout = []
+        size = 0
+        for column_name, dtype in COLUMNS:
+            self.layout.append((column_name, dtype, size, length))
+            size += np.dtype(dtype).itemsize * length
+        self.layout.append(('offsets', np.int64, size, length + 1))
+        size += 8 * (length + 1)
+        self.layout.append(('factors', np.int64, size, factor_capacity))
+        size += 8 * factor_capacity
+        self.layout.append(('is_prime', np.bool_, size, length))
+        size += length
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        # numpy does not pin the buffer it wraps, so every column is a view of one base
+        # array, and the block is only closed once that base is gone
+        self.base = np.ndarray((size,), dtype=np.uint8, buffer=self.shm.buf)
+        self.base_ref = None
+
+    def arrays(self) -> dict:
+        arrays = {}
+        for column_name, dtype, start, count in self.layout:
+            nbytes = np.dtype(dtype).itemsize * count
+            arrays[column_name] = self.base[start:start + nbytes].view(dtype)
+        return arrays
+
+    def write(self, columns: dict, factors: np.ndarray, offsets: np.ndarray):
+        arrays = self.arrays()
+        for column_name, dtype in COLUMNS:
+            arrays[column_name][:] = columns[column_name]
+        arrays['is_prime'][:] = columns['is_prime']
+        arrays['offsets'][:] = offsets
+        arrays['factors'][:len(factors)] = factors
+
+    def to_frame(self) -> pd.DataFrame:
+        '''
+        Wrap the columns into a dataframe that shares the block's memory
+
+        prime_factors holds array views into the flat factors column
+        The frame is only valid until the block is released
+        '''
+        arrays = self.arrays()
+        offsets = arrays['offsets']
+        factors = arrays['factors'][:offsets[-1]]
+        data = {}
+        data['value'] = arrays['value']
+        data['is_prime'] = arrays['is_prime']
+        data['prime_factors'] = np.split(factors, offsets[1:-1]) if self.length > 0 else []
+        for column_name, dtype in COLUMNS[1:]:
+            data[column_name] = arrays[column_name]
+        return pd.DataFrame(data, copy=False)
+
+    def close(self):
+        self.base = None
+        self.shm.close()
+
+    def release(self) -> bool:
+        '''
+        Free the block; returns False while dataframes built on it are still alive
+
+        The name is unlinked straight away, the memory itself goes once the last view is gone
+        '''
+        if self.name is not None:
+            self.shm.unlink()
+            self.name = None
+        if self.base is not None:
+            self.base_ref = weakref.ref(self.base)
+            self.base = None
+        if self.base_ref() is not None:
+            return False
+        self.shm.close()
+        return True
@@ -0,0 +1,17 @@
+import numpy as np
+
+
+def get_value_spans(value_list, gap_limit: int = 64) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Group a list of values into spans of nearby values
+
+    Consecutive sorted values stay in the same span while they are at most gap_limit apart
+    Returns the unique sorted values and the first and last value of each span
+    '''
+    values = np.unique(np.asarray(value_list, dtype=np.int64))
+    if len(values) == 0:
+        return values, values, values
+    breaks = np.flatnonzero(np.diff(values) > gap_limit)
+    span_starts = values[np.concatenate(([0], breaks + 1))]
+    span_ends = values[np.concatenate((breaks, [len(values) - 1]))]
+    return values, span_starts, span_ends